@@ -0,0 +1,214 @@
+"""asyncio runtime running every listener as a coroutine of one process.
+
+Each collection keeps its own :class:`ListenerSpec`, change stream, checkpoint
+and :class:`CollectionHandler` state, exactly as the separate processes do, but
+they all share one event loop, one motor client and one aioboto3 S3 client.
+The snapshot and file writes run in the default executor so they do not
+hold the loop.
+
+Needs ``motor`` and ``aioboto3`` from requirements-extra.txt.  MONGO_URI and
+S3_ENDPOINT_URL point it at local stand-ins (a single-node replica set, an
+S3-compatible server) for tests, see docker-compose.test.yml.
+"""
+import asyncio
+import logging
+import signal
+import time
+
+import aioboto3
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from checkpoints import CheckpointStore
+from backfill import cluster_time, run_resync
+from listener_common import (DATABASE, HISTORY_LOST_CODES, S3_BUCKET, CollectionHandler, change_stream_pipeline, coalesce,
+                             connection_string, set_max_await, setup_logging)
+from multiplex_listener import SPECS
+from raw_bson import RAW_OPTIONS, decode_event
+from settings import (BATCH_MAX_EVENTS, BATCH_MAX_WAIT_MS, COALESCE_WINDOW_MS, FLUSH_EVERY_DOCUMENTS, FLUSH_EVERY_SECONDS,
+                      FULL_DOCUMENT, RAW_BSON, RESTART_DELAY_SECONDS, S3_ENDPOINT_URL, STREAM_MAX_AWAIT_MS)
+from state import StateStore
+
+
+async def iter_batches(stream):
+    """Async counterpart of :func:`listener_common.iter_batches`.
+
+    Yields an empty batch when nothing came for ``STREAM_MAX_AWAIT_MS``, so
+    the caller can flush on time.
+    """
+    while stream.alive:
+        update_change = await stream.try_next()
+        if update_change is None:
+            yield []
+            continue
+
+        batch = [decode_event(update_change)]
+        started = time.monotonic()
+
+        set_max_await(stream, BATCH_MAX_WAIT_MS)
+        try:
+            while len(batch) < BATCH_MAX_EVENTS:
+                elapsed = (time.monotonic() - started) * 1000
+                if elapsed >= max(BATCH_MAX_WAIT_MS, COALESCE_WINDOW_MS):
+                    break
+
+                update_change = await stream.try_next()
+                if update_change is not None:
+                    batch.append(decode_event(update_change))
+                elif elapsed >= COALESCE_WINDOW_MS:
+                    break
+        finally:
+            set_max_await(stream, STREAM_MAX_AWAIT_MS)
+
+        yield coalesce(batch)
+
+
+async def listen(spec, mongo_db, s3, checkpoints, state):
+    """Listen to one collection, resuming from its checkpoint."""
+    collection = mongo_db[spec.collection]
+    # The resync reads through the blocking pymongo collection, in the executor
+    handler = CollectionHandler(spec, collection.delegate, state)
+    loop = asyncio.get_running_loop()
+    # Whether the stream answered once: motor only opens it on the first read
+    opened = False
+
+    def open_stream(**start):
+        return collection.watch(change_stream_pipeline(spec.projection), full_document=FULL_DOCUMENT,
+                                max_await_time_ms=STREAM_MAX_AWAIT_MS, **start)
+
+    def write():
+        return handler.write_files(handler.snapshot())
+
+    async def upload(uploads, deletions):
+        if not uploads and not deletions:
+            return
+
+        while uploads or deletions:
+            # upload files:
+            for filename in uploads:
+                await s3.upload_file(filename, S3_BUCKET, filename)
+            for filename in deletions:
+                await s3.delete_object(Bucket=S3_BUCKET, Key=filename)
+            uploads, deletions = await loop.run_in_executor(None, handler.uploaded, uploads)
+        logging.info(f"Uploaded CSV to S3 ({spec.collection})")
+
+    async def flush(token, cluster_time, events):
+        await upload(*await loop.run_in_executor(None, write))
+        checkpoints.save(spec.collection, token, cluster_time, events)
+
+    async def tick(stopping=False):
+        await upload(*await loop.run_in_executor(None, handler.tick, stopping))
+
+    def resync(since):
+        start_at = cluster_time(mongo_db.delegate)
+        run_resync(handler, since, write=False)
+        return start_at
+
+    async def process(stream):
+        nonlocal resume_token, opened
+        # Applied since the last flush
+        events, cluster_time = 0, None
+        last_flush = time.monotonic()
+
+        try:
+            async for batch in iter_batches(stream):
+                opened = True
+                if batch:
+                    missing = handler.plan_batch(batch)
+                    if missing:
+                        documents = [raw async for raw in collection.aggregate(handler.fetch_pipeline(missing))]
+                        fetched = {element['_id']: element for element in map(spec.decode, documents)}
+                        handler.apply_fetched(missing, fetched)
+
+                    resume_token = stream.resume_token
+                    events, cluster_time = events + len(batch), batch[-1].get('clusterTime')
+
+                # Same flush policy as the threaded runtime
+                if events and (len(handler.table.changed) >= FLUSH_EVERY_DOCUMENTS
+                               or time.monotonic() - last_flush >= FLUSH_EVERY_SECONDS):
+                    flushed, events = events, 0
+                    await flush(resume_token, cluster_time, flushed)
+                    last_flush = time.monotonic()
+                elif not batch:
+                    await tick()
+
+        finally:
+            # Stopping (cancelled on SIGTERM) or failing: write what was applied
+            if events:
+                await flush(resume_token, cluster_time, events)
+            await tick(stopping=True)
+
+    resume_token = checkpoints.load(spec.collection)
+    logging.info(f"Listening {spec.collection}.......")
+
+    try:
+        try:
+            async with open_stream(resume_after=resume_token) as stream:
+                await process(stream)
+
+        except pymongo.errors.OperationFailure as exc:
+            since = checkpoints.load_cluster_time(spec.collection)
+            if opened or exc.code not in HISTORY_LOST_CODES or since is None:
+                raise
+
+            # Same recovery as consume: reload the gap, then start from before it
+            logging.warning(f"Checkpoint of {spec.collection} is no longer in the oplog, resyncing")
+            resume_token = None
+            start_at = await loop.run_in_executor(None, resync, since)
+            await upload(*await loop.run_in_executor(None, write))
+            async with open_stream(start_at_operation_time=start_at) as stream:
+                await process(stream)
+
+    except pymongo.errors.PyMongoError:
+        if resume_token is None:
+            logging.error('...')
+        else:
+            async with open_stream(resume_after=resume_token) as stream:
+                await process(stream)
+
+    finally:
+        handler.table.close()
+
+
+async def supervise(spec, *args):
+    """Run the listener of ``spec``, restarting it when it fails.
+
+    A failure stays within its collection: the other listeners, and the
+    clients they share, keep running.
+    """
+    while True:
+        try:
+            await listen(spec, *args)
+            return
+        except Exception:
+            logging.exception(f"Listener of {spec.collection} failed, restarting in {RESTART_DELAY_SECONDS}s")
+        await asyncio.sleep(RESTART_DELAY_SECONDS)
+
+
+async def run_async(specs):
+    client = AsyncIOMotorClient(connection_string(), serverSelectionTimeoutMS=5000)
+    mongo_db = client.get_database(DATABASE, codec_options=RAW_OPTIONS) if RAW_BSON else client[DATABASE]
+    checkpoints = CheckpointStore()
+    state = StateStore()
+
+    # docker stop: cancel the listeners, which flush on the way out
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    session = aioboto3.Session()
+    async with session.client('s3', endpoint_url=S3_ENDPOINT_URL) as s3:
+        try:
+            await asyncio.gather(*(supervise(spec, mongo_db, s3, checkpoints, state) for spec in specs))
+        finally:
+            checkpoints.flush()
+
+
+def async_listener():
+    setup_logging()
+    try:
+        asyncio.run(run_async(SPECS))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logging.info("Stopped")
+
+
+if __name__ == '__main__':
+    async_listener()
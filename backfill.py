@@ -0,0 +1,130 @@
+"""Full export of a collection, scanned in parallel ``_id`` ranges.
+
+The listeners only see documents that change after they start.  A backfill
+reads the whole collection with the listener's projection, so the exported
+file starts complete; the change stream is then opened at the cluster time
+taken before the scan, so nothing written during the scan is missed.
+
+A resync is the narrow version used when the oplog no longer covers a
+listener's checkpoint: only documents created or modified since then are read.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import queue
+import threading
+
+from bson import ObjectId
+
+from settings import BACKFILL_BATCH_SIZE, BACKFILL_PARTITIONS, BACKFILL_WORKERS
+
+
+def cluster_time(mongo_db):
+    """Current operation time of the cluster, a change stream start point."""
+    return mongo_db.command('ping')['operationTime']
+
+
+def id_ranges(collection, partitions, match=None):
+    """Split the ``_id`` space into about ``partitions`` ranges of similar size.
+
+    Returns ``(lower, upper, last)`` tuples; ``upper`` is exclusive except
+    for the last range, as in ``$bucketAuto``.
+    """
+    pipeline = [{'$match': match}] if match else []
+    pipeline.append({'$bucketAuto': {'groupBy': '$_id', 'buckets': partitions}})
+
+    buckets = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return [(bucket['_id']['min'], bucket['_id']['max'], i == len(buckets) - 1) for i, bucket in enumerate(buckets)]
+
+
+def scan_range(handler, lower, upper, last, batches, stopped):
+    """Scan one range, putting its ``(id, rows)`` on ``batches`` a batch at a time.
+
+    ``batches`` is bounded: a worker ahead of the thread storing the rows
+    waits, so only a few batches per worker are held in memory.
+    """
+    collection, spec = handler.collection, handler.spec
+    query = {'_id': {'$gte': lower, '$lte' if last else '$lt': upper}}
+    if spec.match:
+        query.update(spec.match)
+
+    def put(batch):
+        while not stopped.is_set():
+            try:
+                batches.put(batch, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    batch = []
+    for element in map(spec.decode, collection.find(query, spec.projection, batch_size=BACKFILL_BATCH_SIZE)):
+        batch.append((element['_id'], handler.build_rows(element)))
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            if not put(batch):
+                return
+            batch = []
+    if batch:
+        put(batch)
+
+
+def run_backfill(handler, partitions=BACKFILL_PARTITIONS, workers=BACKFILL_WORKERS):
+    """Load every document of the handler's collection, then write the export once."""
+    spec = handler.spec
+    logging.info(f"Backfilling {spec.collection}.......")
+
+    ranges = id_ranges(handler.collection, partitions, spec.match)
+
+    # The table is only written from this thread
+    batches = queue.Queue(maxsize=2 * workers)
+    stopped = threading.Event()
+    documents = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = {executor.submit(scan_range, handler, *id_range, batches, stopped)
+                 for id_range in ranges}
+        try:
+            while scans or not batches.empty():
+                try:
+                    batch = batches.get(timeout=0.5)
+                except queue.Empty:
+                    # Raises the error of a failed scan
+                    for scan in [scan for scan in scans if scan.done()]:
+                        scan.result()
+                        scans.discard(scan)
+                    continue
+
+                for id, rows in batch:
+                    handler.store(id, rows)
+                documents += len(batch)
+        finally:
+            stopped.set()
+
+    handler.write()
+    logging.info(f"Backfilled {documents} documents ({spec.collection})")
+
+
+def run_resync(handler, since, write=True):
+    """Reload the documents created or modified since ``since`` (a Timestamp).
+
+    New documents are found through their ``_id`` (ObjectIds start with their
+    creation time) and, like modified ones, through the spec's
+    ``resync_fields``; each clause is an indexed range query.  With ``write``
+    false the rows are only stored, the caller writes and uploads them.
+    """
+    spec = handler.spec
+    since_date = since.as_datetime()
+    logging.info(f"Resyncing {spec.collection} since {since_date}.......")
+
+    clauses = [{'_id': {'$gte': ObjectId.from_datetime(since_date)}}]
+    clauses += [{name: {'$gte': since_date}} for name in spec.resync_fields]
+    query = {'$or': clauses}
+    if spec.match:
+        query = {'$and': [spec.match, query]}
+
+    documents = 0
+    for element in map(spec.decode, handler.collection.find(query, spec.projection, batch_size=BACKFILL_BATCH_SIZE)):
+        handler.store(element['_id'], handler.build_rows(element))
+        documents += 1
+
+    if write:
+        handler.write()
+    logging.info(f"Resynced {documents} documents ({spec.collection})")
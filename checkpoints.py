@@ -0,0 +1,80 @@
+"""Durable change stream resume tokens.
+
+Each listener records the resume token of the last batch it processed so a
+restarted process picks the stream up where it stopped, as long as the oplog
+still covers that point.  Tokens are kept in a small SQLite file shared by the
+listener processes; writes are batched so the event loop is not slowed down by
+an fsync per event.
+"""
+import logging
+import sqlite3
+import time
+
+import bson
+
+from settings import CHECKPOINT_EVERY_EVENTS, CHECKPOINT_EVERY_SECONDS, CHECKPOINT_PATH
+
+
+class CheckpointStore:
+    """Last resume token (and its cluster time) per stream, committed in batches."""
+
+    def __init__(self, path=CHECKPOINT_PATH, every_events=CHECKPOINT_EVERY_EVENTS, every_seconds=CHECKPOINT_EVERY_SECONDS):
+        self.every_events = every_events
+        self.every_seconds = every_seconds
+        self.pending = {}
+        self.pending_events = 0
+        self.last_commit = time.monotonic()
+
+        # Loaded from the main thread, saved from the pipeline's output thread
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            '  stream TEXT PRIMARY KEY,'
+            '  resume_token BLOB NOT NULL,'
+            '  updated_at REAL NOT NULL,'
+            '  cluster_time BLOB'
+            ')')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(checkpoints)')]
+        if 'cluster_time' not in columns:
+            self.conn.execute('ALTER TABLE checkpoints ADD COLUMN cluster_time BLOB')
+        self.conn.commit()
+
+    def load(self, stream):
+        """Resume token recorded for ``stream``, or None."""
+        row = self.conn.execute('SELECT resume_token FROM checkpoints WHERE stream = ?', (stream,)).fetchone()
+        if row is None:
+            return None
+        return bson.decode(row[0])
+
+    def load_cluster_time(self, stream):
+        """Cluster time of the last event checkpointed for ``stream``, or None."""
+        row = self.conn.execute('SELECT cluster_time FROM checkpoints WHERE stream = ?', (stream,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return bson.decode(row[0])['clusterTime']
+
+    def save(self, stream, resume_token, cluster_time=None, events=1):
+        """Record a token; it is committed once enough events or time went by."""
+        if resume_token is None:
+            return
+
+        self.pending[stream] = (resume_token, cluster_time)
+        self.pending_events += events
+
+        if self.pending_events >= self.every_events or time.monotonic() - self.last_commit >= self.every_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            now = time.time()
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO checkpoints (stream, resume_token, updated_at, cluster_time) VALUES (?, ?, ?, ?)',
+                [(stream, bson.encode(token), now, bson.encode({'clusterTime': cluster_time}) if cluster_time else None)
+                 for stream, (token, cluster_time) in self.pending.items()])
+            self.conn.commit()
+            logging.debug(f"Checkpointed {', '.join(self.pending)}")
+
+        self.pending = {}
+        self.pending_events = 0
+        self.last_commit = time.monotonic()
@@ -0,0 +1,354 @@
+"""In-memory materialized export of a collection.
+
+Rows are kept per document ``_id`` and replaced in place on every change, so
+memory follows the number of distinct documents and an upsert costs the same
+however long the listener has been running.  Writers get a columnar view
+when they flush.
+
+With a ``max_documents`` budget, the least recently updated documents are
+moved to a scratch SQLite file once the table outgrows it and read from
+there when needed, so a large collection does not have to fit in memory.
+
+Rows are stored as instances of a slotted class generated from the columns
+(see :func:`row_type`) rather than dicts, several times smaller per row.
+Columns typed ``category`` or ``timestamp`` in the spec are stored encoded:
+categories as codes into a dictionary of the table's distinct values, dates
+as int64 microseconds since the epoch.
+"""
+from datetime import datetime, timedelta
+import itertools
+from operator import attrgetter
+import os
+import sqlite3
+import tempfile
+
+import bson
+
+from settings import SPILL_DIR, TABLE_MAX_DOCUMENTS
+
+
+# Distinct values a category column encodes at most, later ones are kept as is
+CATEGORY_MAX_VALUES = 1 << 16
+
+
+class Categories:
+    """Dictionary encoding of a column: each distinct value gets a small int code.
+
+    Codes index ``values``, which only grows, so rows handed to the output
+    thread stay decodable while the table keeps encoding.  Values that cannot
+    get a code (unhashable, or past ``max_values``) are stored wrapped in a
+    1-tuple.
+    """
+
+    def __init__(self, max_values=CATEGORY_MAX_VALUES):
+        self.max_values = max_values
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        # 1 == True == 1.0, only strings are their own key
+        key = value if type(value) is str else (type(value), value)
+        try:
+            code = self.codes.get(key)
+        except TypeError:
+            return (value,)
+
+        if code is None:
+            if len(self.values) >= self.max_values:
+                return (value,)
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[key] = code
+        return code
+
+    def decode(self, code):
+        return self.values[code] if type(code) is int else code[0]
+
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class Timestamps:
+    """Naive datetimes as int64 microseconds since the epoch.
+
+    Other values (None, strings of badly typed documents) are stored as is,
+    wrapped in a 1-tuple unless None.
+    """
+
+    def encode(self, value):
+        if type(value) is datetime and value.tzinfo is None:
+            return (value - EPOCH) // MICROSECOND
+        return None if value is None else (value,)
+
+    def decode(self, value):
+        if type(value) is int:
+            return EPOCH + timedelta(microseconds=value)
+        return None if value is None else value[0]
+
+
+CODECS = {'category': Categories, 'timestamp': Timestamps}
+
+
+def row_type(columns, codecs=None):
+    """Slotted class holding one row of ``columns``, generated like a namedtuple.
+
+    Rows are built from the ``build_rows`` dicts with ``from_dict``, keys
+    outside ``columns`` are ignored and missing ones are None, or created
+    directly by the mappings' row builders.  ``get`` keeps
+    the dict interface the writers use.  The columns in ``codecs`` (column ->
+    codec, see :func:`make_codecs`) are encoded in the slots and decoded by
+    ``get``, ``values`` and ``to_dict``; ``encoded`` returns the slots as is.
+    """
+    columns = tuple(columns)
+    codecs = codecs or {}
+    namespace = {f"encode_{i}": codecs[column].encode for i, column in enumerate(columns) if column in codecs}
+    namespace.update({f"decode_{i}": codecs[column].decode for i, column in enumerate(columns) if column in codecs})
+
+    arguments = ', '.join(f"{column}=None" for column in columns)
+    assignments = ''.join(f"    self.{column} = encode_{i}({column})\n" if column in codecs
+                          else f"    self.{column} = {column}\n" for i, column in enumerate(columns))
+    exec(f"def __init__(self, {arguments}):\n{assignments}", namespace)
+
+    encoded = attrgetter(*columns) if len(columns) > 1 else (lambda row: (getattr(row, columns[0]),))
+    if codecs:
+        decoded = ', '.join(f"decode_{i}(self.{column})" if column in codecs else f"self.{column}"
+                            for i, column in enumerate(columns))
+        exec(f"def values(self):\n    return ({decoded},)", namespace)
+        values = namespace['values']
+    else:
+        values = encoded
+    decoders = {column: codec.decode for column, codec in codecs.items()}
+
+    class Row:
+        __slots__ = columns
+        __init__ = namespace['__init__']
+
+        @classmethod
+        def from_dict(cls, row):
+            return cls(*map(row.get, columns))
+
+        def get(self, column, default=None):
+            if column in decoders:
+                return decoders[column](getattr(self, column))
+            return getattr(self, column, default)
+
+        def values(self):
+            return values(self)
+
+        def encoded(self):
+            return encoded(self)
+
+        def to_dict(self):
+            return dict(zip(columns, values(self)))
+
+        def replace(self, changes):
+            """Copy of the row with ``changes`` (column -> value) applied."""
+            return self.from_dict({**self.to_dict(), **changes})
+
+        def __repr__(self):
+            return f"Row({self.to_dict()!r})"
+
+    return Row
+
+
+def make_codecs(columns, types):
+    """Codec of each of ``columns`` stored encoded, after its type in ``types``."""
+    return {column: CODECS[types[column]]() for column in columns if types.get(column) in CODECS}
+
+
+class SpillFile:
+    """Scratch store of the documents evicted from a table, deleted on close."""
+
+    def __init__(self, directory=SPILL_DIR):
+        fd, self.path = tempfile.mkstemp(prefix='spill-', suffix='.db', dir=directory)
+        os.close(fd)
+        # Used from the asyncio engine's executor threads too
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        # Nothing to recover after a crash; WAL so snapshots read while the
+        # table keeps evicting
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE documents (id BLOB PRIMARY KEY, rows BLOB NOT NULL)')
+
+    # Rows are stored as lists of values, in the table's column order
+
+    def get(self, id):
+        row = self.conn.execute('SELECT rows FROM documents WHERE id = ?', (bson.encode({'_id': id}),)).fetchone()
+        return bson.decode(row[0])['rows']
+
+    def save(self, documents):
+        self.conn.executemany('INSERT OR REPLACE INTO documents (id, rows) VALUES (?, ?)',
+                              [(bson.encode({'_id': id}), bson.encode({'rows': [list(row.values()) for row in rows]}))
+                               for id, rows in documents.items()])
+        self.conn.commit()
+
+    def delete(self, id):
+        self.conn.execute('DELETE FROM documents WHERE id = ?', (bson.encode({'_id': id}),))
+
+    def iter_documents(self):
+        """Values of the stored rows per document, oldest eviction first."""
+        for rows, in self.conn.execute('SELECT rows FROM documents ORDER BY rowid'):
+            yield bson.decode(rows)['rows']
+
+    def reader(self):
+        """Connection reading the documents stored now, whatever is saved later.
+
+        Meant for another thread: the read transaction is held until the
+        connection is closed.
+        """
+        # Deletes are committed with the next save otherwise
+        self.conn.commit()
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute('BEGIN')
+        conn.execute('SELECT count(*) FROM documents').fetchone()
+        return conn
+
+    def close(self):
+        self.conn.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+class TableSnapshot:
+    """The rows of a table at one point, read later on another thread.
+
+    The documents in memory are listed (rows are immutable), the spilled ones
+    are read from the spill file when iterated, through a read transaction
+    taken with the snapshot, so writers do not hold a copy of them.  It can be
+    iterated several times; ``close`` ends the read (so does garbage
+    collection).
+    """
+
+    def __init__(self, table):
+        self.columns = table.columns
+        self.row_type = table.row_type
+        self.unique = table.unique
+        self.documents = list(table.documents.values())
+        self.spill = table.spill.reader() if table.spilled else None
+
+    def __iter__(self):
+        # Spilled documents were updated before the ones in memory
+        documents = self.documents
+        if self.spill is not None:
+            spilled = ([self.row_type(*values) for values in bson.decode(rows)['rows']]
+                       for rows, in self.spill.execute('SELECT rows FROM documents ORDER BY rowid'))
+            documents = itertools.chain(spilled, documents)
+        return self.unique(row for rows in documents for row in rows)
+
+    def to_columns(self, encoded=False):
+        """Columnar view of the rows: column -> list of values.
+
+        With ``encoded`` the columns stored encoded are left encoded.
+        """
+        data = {column: [] for column in self.columns}
+        for row in self:
+            for values, value in zip(data.values(), row.encoded() if encoded else row.values()):
+                values.append(value)
+        return data
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class KeyedTable:
+    """Rows of a collection keyed by document ``_id``, in last-update order."""
+
+    def __init__(self, columns, key_columns=('_id',), max_documents=TABLE_MAX_DOCUMENTS, types=None):
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        # Column -> codec of the encoded columns
+        self.codecs = make_codecs(self.columns, types or {})
+        self.row_type = row_type(self.columns, self.codecs)
+        self.documents = {}
+        # Documents upserted since the last take_changed(), with the change
+        # that last touched them
+        self.changed = {}
+
+        # Documents kept in memory at most (0: no limit), the others are in
+        # the spill file, created the first time the table outgrows it
+        self.max_documents = max_documents
+        self.spill = None
+        self.spilled = set()
+
+    def __len__(self):
+        return len(self.documents) + len(self.spilled)
+
+    def get(self, id):
+        """Rows last stored for a document, or None."""
+        if id in self.spilled:
+            return [self.row_type(*values) for values in self.spill.get(id)]
+        return self.documents.get(id)
+
+    def upsert(self, id, rows, change=None):
+        """Store the rows of a document, dicts or rows of the table's row type.
+
+        ``change`` is the ``(operationType, clusterTime)`` of the change event
+        the rows come from, None when they were read from the collection.
+        """
+        rows = [row if isinstance(row, self.row_type) else self.row_type.from_dict(row) for row in rows]
+
+        if id in self.spilled:
+            self.spilled.remove(id)
+            self.spill.delete(id)
+
+        # Re-inserting moves the document last, like drop_duplicates(keep='last')
+        self.documents.pop(id, None)
+        if rows:
+            self.documents[id] = rows
+        self.changed[id] = change
+
+        if self.max_documents and len(self.documents) > self.max_documents:
+            self.evict()
+
+    def evict(self):
+        """Move the least recently updated documents to the spill file.
+
+        A tenth of the budget goes at once, so evictions are batched.
+        """
+        if self.spill is None:
+            self.spill = SpillFile()
+
+        count = len(self.documents) - self.max_documents * 9 // 10
+        cold = {id: self.documents.pop(id) for id in list(itertools.islice(self.documents, count))}
+        self.spill.save(cold)
+        self.spilled.update(cold)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+    def take_changed(self):
+        """Documents upserted since the last call (id -> change), in upsert order."""
+        changed, self.changed = self.changed, {}
+        return changed
+
+    def iter_rows(self):
+        # Spilled documents were updated before the ones in memory
+        documents = self.documents.values()
+        if self.spilled:
+            spilled = ([self.row_type(*values) for values in rows] for rows in self.spill.iter_documents())
+            documents = itertools.chain(spilled, documents)
+        return self.unique(row for rows in documents for row in rows)
+
+    def snapshot(self):
+        """:class:`TableSnapshot` of the current rows."""
+        return TableSnapshot(self)
+
+    def unique(self, rows):
+        """``rows`` without the ones overwritten by a later row of the same key."""
+        if self.key_columns == ['_id']:
+            yield from rows
+            return
+
+        # Rows keyed on other columns: the last row stored for a key wins.
+        # repr() because those columns may hold sub-documents
+        by_key = {}
+        for row in rows:
+            key = tuple(repr(row.get(column)) for column in self.key_columns)
+            by_key.pop(key, None)
+            by_key[key] = row
+        yield from by_key.values()
@@ -0,0 +1,667 @@
+"""Shared runtime for the collection listeners.
+
+Every ``*_listener.py`` module describes one collection with a
+:class:`ListenerSpec` (the fields to project, the exported columns and how a
+Mongo document maps onto CSV rows).  The code here opens the change stream,
+turns each event into rows and writes/uploads the CSV, reading, transforming
+and writing on separate threads (see :mod:`pipeline`).
+"""
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import argparse
+import logging
+import os
+import signal
+import time
+
+import pymongo
+from bson import ObjectId
+
+from backfill import cluster_time, run_backfill, run_resync
+from checkpoints import CheckpointStore
+from keyed_table import KeyedTable
+from pipeline import Pipeline
+from raw_bson import RAW_OPTIONS, decode_event
+from settings import (BATCH_MAX_EVENTS, BATCH_MAX_WAIT_MS, COALESCE_WINDOW_MS, FLUSH_EVERY_DOCUMENTS, FLUSH_EVERY_SECONDS,
+                      FULL_DOCUMENT, MONGO_URI, RAW_BSON, S3_ENDPOINT_URL, STREAM_MAX_AWAIT_MS, TABLE_MAX_DOCUMENTS)
+from state import StateStore, StateWriter
+from writers import make_writers, write_csv
+
+
+FMT = "%(asctime)s [%(levelname)s] - %(message)s"
+
+DATABASE = "agt4-kenya-prod"
+OUTPUT_DIR = "dags/data/daily_updates"
+S3_BUCKET = "avenews-airflow"
+
+# Change events that carry a document worth exporting
+WATCHED_OPERATIONS = ['update', 'insert', 'replace']
+
+# Errors raised when resuming from a point the oplog no longer covers:
+# CappedPositionLost, ChangeStreamFatalError, ChangeStreamHistoryLost
+HISTORY_LOST_CODES = (136, 280, 286)
+
+# How often the pipeline checks whether a flush is due while idle
+FLUSH_TICK_SECONDS = 0.5
+
+# Change event fields the handlers read, besides the projected fullDocument
+EVENT_FIELDS = ['operationType', 'documentKey', 'ns', 'clusterTime', 'updateDescription']
+
+
+
+@dataclass
+class ListenerSpec:
+    """Static description of one listened collection."""
+
+    # Mongo collection name, also used as the label in the logs
+    collection: str
+    # Base name of the exported file in OUTPUT_DIR
+    output_name: str
+    # Columns of the exported file
+    columns: List[str]
+    # Fields fetched from the collection (a Mongo $project document)
+    projection: Dict[str, int]
+    # Maps one projected document onto zero or more rows
+    build_rows: Callable[[dict], List[dict]]
+    # Makes, for the table's row class, a build_rows creating its instances
+    # directly instead of dicts (Mapping.row_builder)
+    row_builder: Optional[Callable[[type], Callable[[dict], list]]] = None
+    # Columns identifying a row when a document maps onto several rows, the
+    # last written row wins
+    key_columns: List[str] = field(default_factory=lambda: ['_id'])
+    # Turns a raw BSON document (LISTENER_RAW_BSON) into the dict
+    # build_rows reads, decoding only what it needs
+    decode: Callable[[Any], dict] = lambda element: element
+    # Columns copied as-is from one document path: column -> (path, default).
+    # Update events touching only these paths are applied without a refetch
+    delta_columns: Dict[str, Tuple[str, Any]] = field(default_factory=dict)
+    # Filter applied on the server when reading the collection (backfills)
+    match: Optional[dict] = None
+    # Date fields telling a document was created or modified, used to resync
+    # the documents changed while the listener was down for too long
+    resync_fields: List[str] = field(default_factory=lambda: ['dateCreated'])
+    # Typed formats (Parquet, Feather): column -> timestamp, bool, int, float or
+    # category; other columns are written as strings
+    types: Dict[str, str] = field(default_factory=dict)
+    # Date column the partitioned formats split the rows by day on
+    partition_column: Optional[str] = None
+    # Documents kept in memory before spilling to disk (0: no limit), see
+    # keyed_table
+    max_documents: int = TABLE_MAX_DOCUMENTS
+
+    @property
+    def csv_path(self):
+        return f"{OUTPUT_DIR}/{self.output_name}.csv"
+
+    @property
+    def parquet_path(self):
+        return f"{OUTPUT_DIR}/{self.output_name}.parquet"
+
+    @property
+    def feather_path(self):
+        return f"{OUTPUT_DIR}/{self.output_name}.feather"
+
+
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format=FMT,
+        datefmt="%m/%d/%Y %I:%M:%S",
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backfill', action='store_true',
+                        help='export the whole collection before listening to its changes')
+    return parser.parse_args()
+
+
+def connection_string():
+    # MONGO_URI points the listeners at another deployment, e.g. a local replica set
+    if MONGO_URI:
+        return MONGO_URI
+
+    return "mongodb+srv://readonly:" + os.getenv("MONGO_DB_PASSWORD") + "@production.cstrb.mongodb.net/agt4-kenya-prod?" \
+           "authSource=admin&replicaSet=atlas-4ip6rz-shard-0&readPreference=primary&appname=MongoDB%20Compass&ssl=true"
+
+
+def get_database():
+    client = pymongo.MongoClient(connection_string(), serverSelectionTimeoutMS=5000)
+    # Events and documents come raw, decoded only as far as they are read
+    return client.get_database(DATABASE, codec_options=RAW_OPTIONS) if RAW_BSON else client[DATABASE]
+
+
+# Get method for list
+def safe_list_get(l, idx, default):
+    try:
+        return l[idx]
+    except IndexError:
+        return default
+
+
+def get_path(value, path, default):
+    """Follow a dotted path through nested documents."""
+    for key in path.split('.') if path else []:
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def is_related(path, other):
+    """Whether one of two dotted paths is, or contains, the other."""
+    return path == other or path.startswith(other + '.') or other.startswith(path + '.')
+
+
+def merge_projections(projections):
+    """Union of several $project documents.
+
+    A path already covered by one of its parents is dropped, Mongo rejects
+    projections that include both ``a`` and ``a.b``.
+    """
+    paths = sorted({path for projection in projections for path in projection})
+    merged = {}
+    for path in paths:
+        if not any(path.startswith(parent + '.') for parent in merged):
+            merged[path] = 1
+    return merged
+
+
+def change_stream_pipeline(projection, collections=None):
+    """Build the change stream pipeline for a listener projection.
+
+    Uninteresting operations are filtered on the server and the looked-up
+    ``fullDocument`` is trimmed to the listener's projection, so each event
+    arrives with exactly the fields the row mapping needs.  ``collections``
+    restricts a database-level stream to the given collection names.
+    """
+    match = {'operationType': {'$in': WATCHED_OPERATIONS}}
+    if collections is not None:
+        match['ns.coll'] = {'$in': list(collections)}
+
+    project = {name: 1 for name in EVENT_FIELDS}
+    # Unlike a find(), $project keeps the _id of the top-level event only
+    project['fullDocument._id'] = 1
+    project.update({f'fullDocument.{path}': value for path, value in projection.items()})
+
+    return [
+        {'$match': match},
+        {'$project': project},
+    ]
+
+
+def watch(target, projection, collections=None, **kwargs):
+    """Open a change stream on a collection or, with ``collections``, a database."""
+    return target.watch(change_stream_pipeline(projection, collections), full_document=FULL_DOCUMENT,
+                        max_await_time_ms=STREAM_MAX_AWAIT_MS, **kwargs)
+
+
+def set_max_await(stream, max_await_time_ms):
+    """Set how long the next getMores of ``stream`` wait for new events.
+
+    pymongo takes maxAwaitTimeMS once, when the stream is opened, and keeps
+    it on the stream's cursor, in a private attribute renamed by later releases.
+    A motor stream wraps the pymongo one in ``delegate``.
+    """
+    cursor = getattr(getattr(stream, 'delegate', stream), '_cursor', None)
+    for name in ('_max_await_time_ms', '_CommandCursor__max_await_time_ms'):
+        if hasattr(cursor, name):
+            setattr(cursor, name, max_await_time_ms)
+
+
+def iter_batches(stream):
+    """Group the change events of a stream into micro-batches.
+
+    Blocks for the first event of each batch, then drains whatever else is
+    already available on the cursor, up to ``BATCH_MAX_EVENTS`` events or
+    ``BATCH_MAX_WAIT_MS`` milliseconds.  With a ``COALESCE_WINDOW_MS`` window
+    it keeps waiting for events that long even when the cursor runs dry, so
+    bursts on the same documents land in one batch and get coalesced.
+    """
+    for update_change in stream:
+        batch = [decode_event(update_change)]
+        yield coalesce(drain(stream, batch))
+
+
+def drain(stream, batch):
+    """Add the events following the first of ``batch`` to it, see :func:`iter_batches`.
+
+    The getMores issued meanwhile wait ``BATCH_MAX_WAIT_MS`` at most, the
+    stream's longer idle wait is put back after.
+    """
+    started = time.monotonic()
+    set_max_await(stream, BATCH_MAX_WAIT_MS)
+    try:
+        while len(batch) < BATCH_MAX_EVENTS:
+            elapsed = (time.monotonic() - started) * 1000
+            if elapsed >= max(BATCH_MAX_WAIT_MS, COALESCE_WINDOW_MS):
+                break
+
+            update_change = stream.try_next()
+            if update_change is not None:
+                batch.append(decode_event(update_change))
+            elif elapsed >= COALESCE_WINDOW_MS:
+                break
+    finally:
+        set_max_await(stream, STREAM_MAX_AWAIT_MS)
+    return batch
+
+
+def merge_updates(older, newer):
+    """Single updateDescription for two successive updates of a document.
+
+    Returns None when they touch overlapping but different paths (``a`` then
+    ``a.b``), which a merged description cannot express.
+    """
+    if older.get('truncatedArrays') or newer.get('truncatedArrays'):
+        return None
+
+    updated = dict(older.get('updatedFields', {}))
+    removed = list(older.get('removedFields', []))
+
+    for path in list(newer.get('updatedFields', {})) + list(newer.get('removedFields', [])):
+        if any(old != path and is_related(old, path) for old in list(updated) + removed):
+            return None
+
+    for path, value in newer.get('updatedFields', {}).items():
+        updated[path] = value
+        if path in removed:
+            removed.remove(path)
+
+    for path in newer.get('removedFields', []):
+        updated.pop(path, None)
+        if path not in removed:
+            removed.append(path)
+
+    return {'updatedFields': updated, 'removedFields': removed}
+
+
+def coalesce(batch):
+    """Collapse the events of a batch to one per document.
+
+    The newest event wins and takes the place of the last one.  An event
+    carrying its document already has the latest state; update deltas are
+    merged, and when they cannot be the event is left without a delta so the
+    document gets refetched.
+    """
+    latest = {}
+    for update_change in batch:
+        key = (update_change['ns']['coll'], update_change['documentKey']['_id'])
+        previous = latest.pop(key, None)
+
+        if previous is not None and update_change.get('fullDocument') is None:
+            description = None
+            if previous.get('fullDocument') is None and previous['operationType'] == 'update' \
+                    and update_change['operationType'] == 'update':
+                description = merge_updates(previous.get('updateDescription') or {},
+                                            update_change.get('updateDescription') or {})
+            update_change = {**update_change, 'updateDescription': description}
+
+        latest[key] = update_change
+
+    if len(latest) < len(batch):
+        logging.debug(f"Coalesced {len(batch)} events into {len(latest)}")
+
+    return list(latest.values())
+
+
+class CollectionHandler:
+    """Turns change events of one collection into rows of its exported CSV."""
+
+    def __init__(self, spec, collection, state=None):
+        self.spec = spec
+        self.collection = collection
+        self.table = KeyedTable(spec.columns, spec.key_columns, spec.max_documents, types=spec.types)
+        self.build_rows = spec.row_builder(self.table.row_type) if spec.row_builder else spec.build_rows
+        self.writers = make_writers(spec)
+        # Created on first upload, the asyncio engine uploads on its own
+        self.s3 = None
+
+        # Create empty .csv if there is not
+        if not os.path.exists(spec.csv_path):
+            write_csv(spec.csv_path, spec.columns, [])
+
+        if state is not None:
+            self.restore(state)
+            self.writers.insert(0, StateWriter(state, spec))
+
+    def restore(self, state):
+        """Load the rows saved before the last stop into the table."""
+        for id, rows in state.load(self.spec.collection):
+            self.table.upsert(id, rows)
+
+        # The exports on disk already hold these rows: let the writers index
+        # them without writing anything
+        self.snapshot()
+        if len(self.table):
+            logging.info(f"Restored {len(self.table)} documents ({self.spec.collection})")
+
+    def fetch_pipeline(self, ids):
+        # Quering from mongo by ID, one query for the whole batch
+        return [
+            {
+                '$match': {
+                    '_id': {'$in': [ObjectId(id) for id in ids]}
+                }
+            },
+
+            {
+                '$project': self.spec.projection
+            }
+        ]
+
+    def fetch(self, ids):
+        fetched = map(self.spec.decode, self.collection.aggregate(self.fetch_pipeline(ids)))
+        return {element['_id']: element for element in fetched}
+
+    def apply_delta(self, update_change):
+        """Patch the last rows of a document with an update's delta.
+
+        Returns None when the rows are unknown or the delta touches a
+        projected field that is not a plain ``delta_columns`` copy (arrays,
+        derived columns, ...), in which case the document must be refetched.
+        """
+        rows = self.table.get(update_change['documentKey']['_id'])
+        description = update_change.get('updateDescription')
+        if rows is None or description is None or description.get('truncatedArrays'):
+            return None
+
+        changes = {}
+        updates = [(path, value, True) for path, value in description.get('updatedFields', {}).items()]
+        updates += [(path, None, False) for path in description.get('removedFields', [])]
+
+        for path, value, is_set in updates:
+            resolved = False
+            for column, (source, default) in self.spec.delta_columns.items():
+                if source == path or source.startswith(path + '.'):
+                    changes[column] = get_path(value, source[len(path) + 1:], default) if is_set else default
+                    resolved = True
+                elif path.startswith(source + '.'):
+                    # Nested change inside a column copied as a whole
+                    return None
+
+            if not resolved and any(is_related(path, projected) for projected in self.spec.projection):
+                return None
+
+        return [row.replace(changes) for row in rows]
+
+    def store(self, id, rows, change=None):
+        self.table.upsert(id, rows, change)
+
+    def plan_batch(self, batch):
+        """Apply the events that carry their document or a usable delta.
+
+        Returns the documents that must be refetched (id -> change), to be
+        passed with the fetched documents to :meth:`apply_fetched`.
+        """
+        missing = {}
+        for update_change in batch:
+            logging.info(f"Catch type: {update_change['operationType']} ({self.spec.collection})")
+
+            id = update_change['documentKey']['_id']
+            element = update_change.get('fullDocument')
+            change = update_change['operationType'], update_change.get('clusterTime')
+
+            if element is not None:
+                self.store(id, self.build_rows(self.spec.decode(element)), change)
+            elif id not in missing:
+                rows = self.apply_delta(update_change) if update_change['operationType'] == 'update' else None
+                if rows is None:
+                    missing[id] = change
+                else:
+                    self.store(id, rows, change)
+
+        return missing
+
+    def apply_fetched(self, missing, fetched):
+        for id, change in missing.items():
+            element = fetched.get(id)
+            if element is not None:
+                self.store(id, self.build_rows(element), change)
+
+    def apply_batch(self, batch):
+        # Events that neither carry a document nor a usable delta are refetched
+        # together once the batch has been walked
+        missing = self.plan_batch(batch)
+        if missing:
+            self.apply_fetched(missing, self.fetch(missing))
+
+    def snapshot(self):
+        """What each writer needs from the table, taken on the transform thread."""
+        changed = self.table.take_changed()
+        return [writer.prepare(self.table, changed) for writer in self.writers]
+
+    def merge_snapshots(self, older, newer):
+        return [writer.merge(o, n) for writer, o, n in zip(self.writers, older, newer)]
+
+    def write(self):
+        self.write_snapshot(self.snapshot())
+
+    def write_snapshot(self, snapshot):
+        uploads, deletions = self.write_files(snapshot)
+        self.upload(uploads, deletions)
+
+    def write_files(self, snapshot):
+        """Write the snapshot, returning the files to upload and to delete."""
+        uploads, deletions = [], []
+        for writer, payload in zip(self.writers, snapshot):
+            written, removed = writer.write(payload)
+            uploads += written
+            deletions += removed
+        return uploads, deletions
+
+    def tick(self, stopping=False):
+        """Run the writers' work due on time, returning the files to upload and to delete."""
+        uploads, deletions = [], []
+        for writer in self.writers:
+            if hasattr(writer, 'tick'):
+                written, removed = writer.tick(stopping)
+                uploads += written
+                deletions += removed
+        return uploads, deletions
+
+    def uploaded(self, uploads):
+        """Tell the writers which files reached S3, returning what they upload and delete next."""
+        next_uploads, next_deletions = [], []
+        for writer in self.writers:
+            if hasattr(writer, 'uploaded'):
+                written, removed = writer.uploaded(uploads)
+                next_uploads += written
+                next_deletions += removed
+        return next_uploads, next_deletions
+
+    def upload(self, uploads, deletions=()):
+        if not uploads and not deletions:
+            return
+        if self.s3 is None:
+            # boto3 takes a while to import, listeners that never upload skip it
+            import boto3
+            self.s3 = boto3.resource('s3', endpoint_url=S3_ENDPOINT_URL)
+
+        while uploads or deletions:
+            # upload files:
+            for filename in uploads:
+                self.s3.meta.client.upload_file(Filename=filename, Bucket=S3_BUCKET, Key=filename)
+            for filename in deletions:
+                self.s3.meta.client.delete_object(Bucket=S3_BUCKET, Key=filename)
+            uploads, deletions = self.uploaded(uploads)
+
+        logging.info(f"Uploaded CSV to S3 ({self.spec.collection})")
+
+
+def consume(open_stream, handlers, checkpoints, name, start_at_operation_time=None, resync=None):
+    """Feed the change stream to ``handlers``, a dict of handlers by collection name.
+
+    ``open_stream`` opens the stream, taking the watch keyword arguments.  The
+    stream starts at ``start_at_operation_time`` when given, otherwise after
+    the token checkpointed under ``name``; it is resumed once from the last
+    read batch after a driver error.  Changes are written on a flush policy
+    (FLUSH_EVERY_SECONDS, FLUSH_EVERY_DOCUMENTS, or when stopping on Ctrl-C or
+    SIGTERM), and a token is checkpointed once its batch has been written.
+
+    When the checkpoint has already left the oplog, ``resync`` is called with
+    the cluster time of the checkpoint to reload what changed since; it
+    returns the operation time the stream restarts from.
+    """
+    resume_token = None
+    if start_at_operation_time is not None:
+        start = {'start_at_operation_time': start_at_operation_time}
+    else:
+        resume_token = checkpoints.load(name)
+        start = {'resume_after': resume_token}
+        if resume_token is not None:
+            logging.info(f"Resuming {name} from checkpoint")
+
+    # Applied but not yet flushed: touched handlers, last batch token/time
+    touched = {}
+    pending = None
+    events = 0
+    last_flush = time.monotonic()
+
+    def transform(items, stopping):
+        nonlocal pending, events, last_flush
+        for batch, token in items:
+            by_collection = {}
+            for update_change in batch:
+                by_collection.setdefault(update_change['ns']['coll'], []).append(update_change)
+
+            for coll, changes in by_collection.items():
+                handlers[coll].apply_batch(changes)
+                touched[coll] = handlers[coll]
+
+            pending = token, batch[-1].get('clusterTime')
+            events += len(batch)
+
+        # Flush every FLUSH_EVERY_SECONDS, FLUSH_EVERY_DOCUMENTS or on the way out
+        dirty = sum(len(handler.table.changed) for handler in touched.values())
+        if pending is None or not (stopping or dirty >= FLUSH_EVERY_DOCUMENTS
+                                   or time.monotonic() - last_flush >= FLUSH_EVERY_SECONDS):
+            return None
+
+        snapshots = {coll: handler.snapshot() for coll, handler in touched.items()}
+        flush = snapshots, *pending, events
+
+        touched.clear()
+        pending = None
+        events = 0
+        last_flush = time.monotonic()
+        return flush
+
+    def output(items, stopping):
+        # One write per collection, however many snapshots are queued
+        snapshots = {}
+        for item_snapshots, _, _, _ in items:
+            for coll, snapshot in item_snapshots.items():
+                if coll in snapshots:
+                    snapshot = handlers[coll].merge_snapshots(snapshots[coll], snapshot)
+                snapshots[coll] = snapshot
+
+        for coll, snapshot in snapshots.items():
+            handlers[coll].write_snapshot(snapshot)
+
+        # Called on every tick too: segments rotate on time without changes
+        for handler in handlers.values():
+            handler.upload(*handler.tick(stopping))
+
+        if items:
+            _, resume_token, cluster_time, _ = items[-1]
+            checkpoints.save(name, resume_token, cluster_time, sum(events for _, _, _, events in items))
+
+    def read(stream, pipeline):
+        nonlocal resume_token
+        for batch in iter_batches(stream):
+            pipeline.put((batch, stream.resume_token))
+            resume_token = stream.resume_token
+
+    # docker stop: leave like on Ctrl-C, flushing what is pending
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        try:
+            stream = open_stream(**start)
+        except pymongo.errors.OperationFailure as exc:
+            since = checkpoints.load_cluster_time(name)
+            if exc.code not in HISTORY_LOST_CODES or resync is None or since is None:
+                raise
+
+            # The resync writes the tables itself: done before the pipeline
+            # threads start using them
+            logging.warning(f"Checkpoint of {name} is no longer in the oplog, resyncing")
+            resume_token = None
+            stream = open_stream(start_at_operation_time=resync(since))
+
+        with Pipeline([transform, output], tick=FLUSH_TICK_SECONDS) as pipeline:
+            try:
+                with stream:
+                    read(stream, pipeline)
+
+            except pymongo.errors.PyMongoError:
+                if resume_token is None:
+                    logging.error('...')
+                else:
+                    with open_stream(resume_after=resume_token) as stream:
+                        read(stream, pipeline)
+
+    except KeyboardInterrupt:
+        logging.info(f"Stopped {name}")
+
+    finally:
+        checkpoints.flush()
+        for handler in handlers.values():
+            handler.table.close()
+
+
+def resync_handlers(mongo_db, handlers):
+    """``consume`` resync callback reloading the gap of the given handlers."""
+    def resync(since):
+        start_at = cluster_time(mongo_db)
+        for handler in handlers:
+            run_resync(handler, since)
+        return start_at
+
+    return resync
+
+
+def run_listener(spec, backfill=False):
+    setup_logging()
+
+    mongo_db = get_database()
+    collection = mongo_db[spec.collection]
+    handler = CollectionHandler(spec, collection, StateStore())
+
+    # The stream picks up from the moment the backfill started
+    start_at = None
+    if backfill:
+        start_at = cluster_time(mongo_db)
+        run_backfill(handler)
+
+    logging.info(f"Listening {spec.collection}.......")
+
+    consume(lambda **kwargs: watch(collection, spec.projection, **kwargs), {spec.collection: handler},
+            CheckpointStore(), spec.collection, start_at, resync_handlers(mongo_db, [handler]))
+
+
+def run_multiplexed(specs, backfill=False):
+    """Listen to several collections through one database-level change stream.
+
+    All collections share one client, one cursor and one set of monitor
+    threads; each event goes to the handler of its ``ns.coll``.
+    """
+    setup_logging()
+
+    mongo_db = get_database()
+    state = StateStore()
+    handlers = {spec.collection: CollectionHandler(spec, mongo_db[spec.collection], state) for spec in specs}
+    projection = merge_projections(spec.projection for spec in specs)
+
+    start_at = None
+    if backfill:
+        start_at = cluster_time(mongo_db)
+        for handler in handlers.values():
+            run_backfill(handler)
+
+    logging.info(f"Listening {', '.join(handlers)}.......")
+
+    consume(lambda **kwargs: watch(mongo_db, projection, collections=handlers, **kwargs), handlers,
+            CheckpointStore(), DATABASE, start_at, resync_handlers(mongo_db, handlers.values()))
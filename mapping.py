@@ -0,0 +1,162 @@
+"""Declarative document -> row mappings, compiled into extractor functions.
+
+A listener lists its exported columns as :class:`Field` entries: the column,
+the dotted source path in the Mongo document and the default used when the
+path is missing.  A path segment may pick a list item, ``products[0].name``
+reading the first product's name (the ``safe_list_get(..., 0, {})`` rule).
+
+:func:`compile_fields` generates one extractor function per collection in
+which every nested document on the way is looked up once per document,
+returning a row dict or, through ``row_builder``, an instance of the table's
+row class without a dict in between.  It also derives from the same fields the columns, the ``$project`` document and the
+columns update deltas can patch in place.  ``Mapping.decode`` turns a raw
+BSON document into a dict of only the fields the mapping reads (see
+:mod:`raw_bson`).
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import re
+
+from bson.raw_bson import RawBSONDocument
+
+from listener_common import merge_projections
+from raw_bson import decode_fields
+
+
+# Stands for a missing or non-document value in the middle of a path
+EMPTY = {}
+
+SEGMENT = re.compile(r'^(\w+)(?:\[(\d+)\])?$')
+
+
+@dataclass
+class Field:
+    """One exported column."""
+
+    column: str
+    # Dotted path in the document, segments may end with a list index: a[0].b
+    path: str
+    default: Any = None
+    # Applied to the value (or the default) read from the path
+    transform: Optional[Callable[[Any], Any]] = None
+
+    def segments(self):
+        """``(key, index)`` pairs of the path, index None for plain keys."""
+        segments = []
+        for segment in self.path.split('.'):
+            match = SEGMENT.match(segment)
+            if match is None:
+                raise ValueError(f"bad path segment {segment!r} in {self.path!r}")
+            key, index = match.groups()
+            segments.append((key, None if index is None else int(index)))
+        return segments
+
+
+def as_document(value):
+    return value if isinstance(value, dict) else EMPTY
+
+
+def item(value, index, default):
+    return value[index] if isinstance(value, list) and len(value) > index else default
+
+
+@dataclass
+class Mapping:
+    columns: List[str]
+    projection: Dict[str, int]
+    delta_columns: Dict[str, Tuple[str, Any]]
+    # Projected document -> row dict
+    extract: Callable[[dict], dict]
+    # Projected document, row class -> row
+    make_row: Callable[[dict, type], Any]
+    source: str
+    # Top-level fields read: name -> None (whole) or the list indexes read
+    wanted: Dict[str, Optional[List[int]]]
+
+    def build_rows(self, element):
+        return [self.extract(element)]
+
+    def row_builder(self, row_type):
+        """``build_rows`` creating ``row_type`` instances (see keyed_table) directly."""
+        if list(row_type.__slots__) != self.columns:
+            raise ValueError(f"row class columns {row_type.__slots__} are not the mapping's {self.columns}")
+        make_row = self.make_row
+        return lambda element: [make_row(element, row_type)]
+
+    def decode(self, element):
+        """Plain dict of the fields the mapping reads, for raw documents."""
+        if isinstance(element, RawBSONDocument):
+            return decode_fields(element.raw, self.wanted)
+        return element
+
+
+def compile_fields(fields):
+    """Compile ``fields`` into a :class:`Mapping`."""
+    namespace = {'as_document': as_document, 'item': item, 'EMPTY': EMPTY}
+    lines = []
+    # Path prefix -> variable holding the document found there
+    documents = {(): 'element'}
+
+    def lookup(parent, key, index, default):
+        if index is None:
+            return f"{parent}.get({key!r}, {default})"
+        return f"item({parent}.get({key!r}), {index}, {default})"
+
+    values = []
+    for i, field in enumerate(fields):
+        segments = field.segments()
+        namespace[f"default_{i}"] = field.default
+
+        # Nested documents on the way, each looked up once
+        parent = 'element'
+        for depth in range(1, len(segments)):
+            prefix = tuple(segments[:depth])
+            if prefix not in documents:
+                documents[prefix] = f"document_{len(documents)}"
+                key, index = segments[depth - 1]
+                lines.append(f"    {documents[prefix]} = as_document({lookup(parent, key, index, 'EMPTY')})")
+            parent = documents[prefix]
+
+        key, index = segments[-1]
+        value = lookup(parent, key, index, f"default_{i}")
+        if field.transform is not None:
+            namespace[f"transform_{i}"] = field.transform
+            value = f"transform_{i}({value})"
+        values.append((field.column, value))
+
+    # The same lookups, once into a dict and once into the row class
+    source = '\n'.join([
+        'def extract(element):', *lines, '    return {', *(f"        {column!r}: {value}," for column, value in values), '    }',
+        '', 'def make_row(element, row_type):', *lines, '    return row_type(', *(f"        {value}," for _, value in values),
+        '    )', ''])
+    exec(compile(source, '<mapping>', 'exec'), namespace)
+
+    # Fields read through a list item project the whole list: updates reach
+    # it as positional paths (products.0.name) that must match the projection
+    paths = []
+    for field in fields:
+        segments = field.segments()
+        for depth, (_, index) in enumerate(segments):
+            if index is not None:
+                segments = segments[:depth + 1]
+                break
+        paths.append('.'.join(key for key, _ in segments))
+
+    wanted = {}
+    for field in fields:
+        key, index = field.segments()[0]
+        if index is None or (key in wanted and wanted[key] is None):
+            wanted[key] = None
+        else:
+            wanted[key] = sorted({*wanted.get(key, []), index})
+
+    return Mapping(
+        columns=[field.column for field in fields],
+        projection=merge_projections([{path: 1 for path in paths if path != '_id'}]),
+        delta_columns={field.column: (field.path, field.default) for field in fields
+                       if field.column != '_id' and field.transform is None and '[' not in field.path},
+        extract=namespace['extract'],
+        make_row=namespace['make_row'],
+        source=source,
+        wanted=wanted,
+    )
@@ -0,0 +1,40 @@
+from listener_common import parse_args, run_multiplexed
+
+import accounts_listener
+import agribusinesses_listener
+import cashflow_events_goals_listener
+import cashflow_events_listener
+import invoices_listener
+import loanapplication_listener
+import loandeals_listener
+import loanoffers_listener
+import loanproducts_listener
+import mlscore_listener
+import organizations_listener
+import trades_listener
+import users_listener
+
+
+SPECS = [
+    users_listener.SPEC,
+    trades_listener.SPEC,
+    organizations_listener.SPEC,
+    mlscore_listener.SPEC,
+    loanproducts_listener.SPEC,
+    loanoffers_listener.SPEC,
+    loandeals_listener.SPEC,
+    loanapplication_listener.SPEC,
+    invoices_listener.SPEC,
+    cashflow_events_listener.SPEC,
+    cashflow_events_goals_listener.SPEC,
+    agribusinesses_listener.SPEC,
+    accounts_listener.SPEC,
+]
+
+
+def multiplex_listener(backfill=False):
+    run_multiplexed(SPECS, backfill=backfill)
+
+
+if __name__ == '__main__':
+    multiplex_listener(parse_args().backfill)
@@ -0,0 +1,111 @@
+"""Threaded stages between the change stream and the exported files.
+
+The thread reading the change stream only hands batches over; turning them
+into rows and writing/uploading the exports run on their own threads, joined
+by bounded queues.  A slow S3 upload no longer leaves the cursor idle, and a
+full queue makes the reader wait instead of piling batches up in memory.
+
+Each stage takes every item waiting in its queue at once, so under a burst a
+stage catches up with one pass (one snapshot, one upload) instead of one pass
+per batch.  With a ``tick``, stages are also called with no items when their
+queue stayed empty that long, so they can act on time (flush on a timer).
+"""
+import logging
+import queue
+import threading
+
+from settings import PIPELINE_QUEUE_SIZE
+
+
+# Sent down the queues once the reader is done
+STOP = object()
+
+
+class PipelineError(Exception):
+    """A stage thread failed, the pipeline cannot make progress."""
+
+
+class Pipeline:
+    """Runs ``stages`` on one thread each, fed through bounded queues.
+
+    Every stage is called with the list of items drained from its queue and
+    whether the pipeline is stopping (the last call); what it returns, unless
+    None, is queued for the next stage (the last stage's return value is
+    dropped).
+    """
+
+    def __init__(self, stages, maxsize=PIPELINE_QUEUE_SIZE, tick=None):
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.tick = tick
+        self.error = None
+        self.threads = [
+            threading.Thread(target=self.run_stage, name=f"pipeline-{work.__name__}",
+                             args=(work, inbox, outbox), daemon=True)
+            for work, inbox, outbox in zip(stages, self.queues, self.queues[1:] + [None])
+        ]
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On success or when asked to stop, wait for the queued batches to be
+        # written, otherwise let the daemon threads go with the process
+        if exc_type is None or issubclass(exc_type, KeyboardInterrupt):
+            self.close()
+
+    def put(self, item):
+        """Queue an item for the first stage, waiting while the queue is full."""
+        self.put_into(self.queues[0], item)
+
+    def put_into(self, inbox, item):
+        while True:
+            self.check()
+            try:
+                inbox.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def check(self):
+        if self.error is not None:
+            raise PipelineError('pipeline stage failed') from self.error
+
+    def close(self):
+        self.put(STOP)
+        for thread in self.threads:
+            thread.join()
+        self.check()
+
+    def run_stage(self, work, inbox, outbox):
+        try:
+            stopped = False
+            while not stopped:
+                try:
+                    items = [inbox.get(timeout=self.tick)]
+                except queue.Empty:
+                    items = []
+
+                while True:
+                    try:
+                        items.append(inbox.get_nowait())
+                    except queue.Empty:
+                        break
+
+                for i, item in enumerate(items):
+                    if item is STOP:
+                        items = items[:i]
+                        stopped = True
+                        break
+
+                result = work(items, stopped)
+                if outbox is not None and result is not None:
+                    self.put_into(outbox, result)
+
+            if outbox is not None:
+                self.put_into(outbox, STOP)
+
+        except BaseException as exc:
+            logging.exception(f"Pipeline stage {work.__name__} failed")
+            self.error = exc
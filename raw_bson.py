@@ -0,0 +1,122 @@
+"""Partial decoding of raw BSON documents.
+
+With LISTENER_RAW_BSON the listeners read change events and documents as
+:class:`RawBSONDocument` and decode only what they use: the event fields
+besides ``fullDocument``, and in the documents the top-level fields their
+mapping reads (for ``products[0].name``, only the first product).  The
+elements of a document are walked over without decoding the others.
+"""
+import struct
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+# Codec of the collections and streams read raw
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument, tz_aware=False)
+# Codec of the decoded parts, pymongo's defaults
+DECODE_OPTIONS = CodecOptions()
+
+INT32 = struct.Struct('<i')
+
+# Value sizes of the fixed-size BSON types
+FIXED_SIZES = {
+    0x01: 8,   # double
+    0x06: 0,   # undefined
+    0x07: 12,  # ObjectId
+    0x08: 1,   # bool
+    0x09: 8,   # UTC datetime
+    0x0A: 0,   # null
+    0x10: 4,   # int32
+    0x11: 8,   # timestamp
+    0x12: 8,   # int64
+    0x13: 16,  # decimal128
+    0x7F: 0,   # max key
+    0xFF: 0,   # min key
+}
+# Types starting with their int32 size, or an int32 length of what follows
+SIZED = (0x03, 0x04, 0x0F)
+STRINGS = (0x02, 0x0D, 0x0E)
+
+DOCUMENT, ARRAY = 0x03, 0x04
+
+
+def value_end(raw, kind, start):
+    """End offset of the value of type ``kind`` starting at ``start``."""
+    if kind in FIXED_SIZES:
+        return start + FIXED_SIZES[kind]
+    if kind in SIZED:
+        return start + INT32.unpack_from(raw, start)[0]
+    if kind in STRINGS:
+        return start + 4 + INT32.unpack_from(raw, start)[0]
+    if kind == 0x05:
+        # binary: length, subtype, data
+        return start + 5 + INT32.unpack_from(raw, start)[0]
+    if kind == 0x0B:
+        # regex: pattern and options cstrings
+        return raw.index(b'\x00', raw.index(b'\x00', start) + 1) + 1
+    if kind == 0x0C:
+        # DBPointer: string and ObjectId
+        return start + 4 + INT32.unpack_from(raw, start)[0] + 12
+    raise bson.errors.InvalidBSON(f"unknown BSON type {kind:#x}")
+
+
+def iter_elements(raw, start=0):
+    """Yield ``(name, kind, element_start, value_start, end)`` of a document's top-level elements."""
+    position = start + 4
+    last = start + INT32.unpack_from(raw, start)[0] - 1
+    while position < last:
+        kind = raw[position]
+        name_end = raw.index(b'\x00', position + 1)
+        end = value_end(raw, kind, name_end + 1)
+        yield raw[position + 1:name_end].decode(), kind, position, name_end + 1, end
+        position = end
+
+
+def decode_element(raw, start, end):
+    """Decode one element (type, name and value) of a document."""
+    element = raw[start:end]
+    document = bson.decode(INT32.pack(len(element) + 5) + element + b'\x00', DECODE_OPTIONS)
+    return next(iter(document.values()))
+
+
+def decode_fields(raw, wanted):
+    """Decode the top-level fields of ``raw`` listed in ``wanted``.
+
+    ``wanted`` maps a field name to None to decode the whole value, or to
+    the list indexes to decode when the value is an array: the array comes
+    back cut after the last of them.
+    """
+    document = {}
+    for name, kind, start, value_start, end in iter_elements(raw):
+        if name not in wanted:
+            continue
+
+        indexes = wanted[name]
+        if indexes is None or kind != ARRAY:
+            document[name] = decode_element(raw, start, end)
+            continue
+
+        items = []
+        for key, _, item_start, _, item_end in iter_elements(raw, value_start):
+            if len(items) > max(indexes):
+                break
+            items.append(decode_element(raw, item_start, item_end) if int(key) in indexes else None)
+        document[name] = items
+
+    return document
+
+
+def decode_event(event):
+    """Decode a raw change event, leaving ``fullDocument`` raw."""
+    if not isinstance(event, RawBSONDocument):
+        return event
+
+    raw = event.raw
+    decoded = {}
+    for name, kind, start, value_start, end in iter_elements(raw):
+        if name == 'fullDocument' and kind == DOCUMENT:
+            decoded[name] = RawBSONDocument(raw[value_start:end], RAW_OPTIONS)
+        else:
+            decoded[name] = decode_element(raw, start, end)
+    return decoded
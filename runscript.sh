@@ -1,4 +1,13 @@
 #!/bin/bash
+# LISTENER_MODE=multiplex runs every listener on a single database-level change stream,
+# LISTENER_MODE=async runs them as coroutines of one asyncio process
+if [ "$LISTENER_MODE" = "multiplex" ]; then
+    exec python3 multiplex_listener.py
+fi
+if [ "$LISTENER_MODE" = "async" ]; then
+    exec python3 async_listener.py
+fi
+
 python3 users_listener.py &
 python3 trades_listener.py &
 python3 organizations_listener.py &
@@ -0,0 +1,86 @@
+"""Listener settings, read from the environment (and the .env file)."""
+import os
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# 'updateLookup' ships the document with update events, 'default' leaves them
+# without it and the documents are refetched in batches instead
+FULL_DOCUMENT = os.getenv('LISTENER_FULL_DOCUMENT', 'updateLookup')
+
+# Read events and documents as raw BSON, decoding only the mapped fields
+RAW_BSON = os.getenv('LISTENER_RAW_BSON', '').lower() in ('1', 'true', 'yes')
+
+# Events drained from the cursor per batch, and for how long at most
+BATCH_MAX_EVENTS = int(os.getenv('LISTENER_BATCH_MAX_EVENTS', '500'))
+BATCH_MAX_WAIT_MS = int(os.getenv('LISTENER_BATCH_MAX_WAIT_MS', '200'))
+
+# How long a getMore on an idle change stream waits for events (the server's
+# default); the shorter BATCH_MAX_WAIT_MS only applies while draining a batch
+STREAM_MAX_AWAIT_MS = int(os.getenv('LISTENER_STREAM_MAX_AWAIT_MS', '1000'))
+
+# How long a batch keeps collecting events so repeated changes to the same
+# document collapse into one (0: only what is already buffered)
+COALESCE_WINDOW_MS = int(os.getenv('LISTENER_COALESCE_WINDOW_MS', '0'))
+
+# Exports are rewritten at most every this many seconds, or sooner once this
+# many documents changed (and when the listener stops)
+FLUSH_EVERY_SECONDS = float(os.getenv('LISTENER_FLUSH_EVERY_SECONDS', '5'))
+FLUSH_EVERY_DOCUMENTS = int(os.getenv('LISTENER_FLUSH_EVERY_DOCUMENTS', '10000'))
+
+# Resume token store; a pending token is committed after this many events or seconds
+CHECKPOINT_PATH = os.getenv('LISTENER_CHECKPOINT_PATH', 'dags/data/checkpoints.db')
+CHECKPOINT_EVERY_EVENTS = int(os.getenv('LISTENER_CHECKPOINT_EVERY_EVENTS', '100'))
+CHECKPOINT_EVERY_SECONDS = float(os.getenv('LISTENER_CHECKPOINT_EVERY_SECONDS', '5'))
+
+# Rows of the exported documents, reloaded when a listener restarts
+STATE_PATH = os.getenv('LISTENER_STATE_PATH', 'dags/data/state.db')
+
+# Documents of a collection kept in memory (0: no limit); the least recently
+# updated ones beyond are moved to a scratch file in LISTENER_SPILL_DIR
+# (the system's temporary directory by default).  Default of the specs'
+# max_documents, which a listener can set for its collection
+TABLE_MAX_DOCUMENTS = int(os.getenv('LISTENER_TABLE_MAX_DOCUMENTS', '0'))
+SPILL_DIR = os.getenv('LISTENER_SPILL_DIR')
+
+# --backfill: the _id space is split in this many ranges, scanned by this many threads
+BACKFILL_PARTITIONS = int(os.getenv('LISTENER_BACKFILL_PARTITIONS', '16'))
+BACKFILL_WORKERS = int(os.getenv('LISTENER_BACKFILL_WORKERS', '4'))
+BACKFILL_BATCH_SIZE = int(os.getenv('LISTENER_BACKFILL_BATCH_SIZE', '2000'))
+
+# Batches waiting between two pipeline stages before the reader is held back
+PIPELINE_QUEUE_SIZE = int(os.getenv('LISTENER_QUEUE_SIZE', '8'))
+
+# asyncio runtime: a failed listener is restarted after this many seconds,
+# the others keep running
+RESTART_DELAY_SECONDS = float(os.getenv('LISTENER_RESTART_DELAY_SECONDS', '30'))
+
+# Exported formats, comma separated (see writers.py): csv, csv-log,
+# csv-partitioned, csv-delta, cdc, parquet, feather
+OUTPUT_FORMATS = os.getenv('LISTENER_OUTPUTS', 'csv').split(',')
+
+# csv-log: a log segment is closed at this size; segments are compacted into
+# the snapshot after this many seconds or once they add up to this size
+LOG_SEGMENT_MAX_BYTES = int(os.getenv('LISTENER_LOG_SEGMENT_MAX_BYTES', str(16 * 1024 * 1024)))
+COMPACT_EVERY_SECONDS = float(os.getenv('LISTENER_COMPACT_EVERY_SECONDS', '900'))
+COMPACT_MAX_BYTES = int(os.getenv('LISTENER_COMPACT_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# csv-delta: a new base snapshot is written after this many seconds, or once
+# the deltas since the last one add up to this fraction of its size
+DELTA_REBASE_EVERY_SECONDS = float(os.getenv('LISTENER_DELTA_REBASE_EVERY_SECONDS', '3600'))
+DELTA_REBASE_MAX_RATIO = float(os.getenv('LISTENER_DELTA_REBASE_MAX_RATIO', '0.5'))
+
+# cdc: the open segment is closed and uploaded at this size or age
+CDC_SEGMENT_MAX_BYTES = int(os.getenv('LISTENER_CDC_SEGMENT_MAX_BYTES', str(64 * 1024 * 1024)))
+CDC_SEGMENT_MAX_SECONDS = float(os.getenv('LISTENER_CDC_SEGMENT_MAX_SECONDS', '3600'))
+
+# parquet: codec and rows per row group (record batch for feather)
+PARQUET_COMPRESSION = os.getenv('LISTENER_PARQUET_COMPRESSION', 'zstd')
+PARQUET_ROW_GROUP_SIZE = int(os.getenv('LISTENER_PARQUET_ROW_GROUP_SIZE', '100000'))
+
+# Other deployments to talk to instead of production, e.g. local stand-ins for
+# tests: a single-node replica set and an S3-compatible server
+MONGO_URI = os.getenv('MONGO_URI')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
@@ -0,0 +1,51 @@
+"""End-to-end check of a listener runtime against local stand-ins.
+
+Run by docker-compose.test.yml next to the listeners: writes a loan product
+to the replica set, then waits for its row in the CSV the listener uploads to
+the S3 stand-in.  Exits with 1 when the row does not show up in time.
+"""
+import logging
+import sys
+import time
+
+import boto3
+import pymongo
+from bson import ObjectId
+
+from listener_common import DATABASE, S3_BUCKET, connection_string, setup_logging
+from loanproducts_listener import SPEC
+from settings import S3_ENDPOINT_URL
+
+TIMEOUT_SECONDS = 120
+
+
+def smoke_test():
+    setup_logging()
+    collection = pymongo.MongoClient(connection_string(), serverSelectionTimeoutMS=5000)[DATABASE][SPEC.collection]
+    s3 = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+
+    id = ObjectId()
+    collection.insert_one({'_id': id, 'name': 'smoke test', 'productType': 'smoke'})
+
+    deadline = time.monotonic() + TIMEOUT_SECONDS
+    touches = 0
+    while time.monotonic() < deadline:
+        # Changes made before the listener opened its stream are not seen, keep making new ones
+        touches += 1
+        collection.update_one({'_id': id}, {'$set': {'name': f"smoke test {touches}"}})
+        time.sleep(2)
+
+        try:
+            body = s3.get_object(Bucket=S3_BUCKET, Key=SPEC.csv_path)['Body'].read().decode()
+        except s3.exceptions.NoSuchKey:
+            continue
+        if str(id) in body:
+            logging.info(f"Row of {id} uploaded to {SPEC.csv_path}")
+            return 0
+
+    logging.error(f"No row of {id} in {SPEC.csv_path} after {TIMEOUT_SECONDS}s")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(smoke_test())
@@ -0,0 +1,81 @@
+"""Durable copy of the exported rows.
+
+The listeners hold the exported rows of their collection in memory; without a
+copy on disk a restarted listener starts from an empty table and its first
+write truncates the export to the documents changed since.  The rows of every
+document are kept in a SQLite file next to the checkpoints and loaded back
+into the table at startup.
+
+Rows are saved by :class:`StateWriter`, which the handlers run before their
+output writers, so they are committed before the batch's resume token is.
+"""
+import logging
+import sqlite3
+import threading
+
+import bson
+
+from settings import STATE_PATH
+
+
+class StateStore:
+    """Rows of each collection's documents, keyed by collection and ``_id``."""
+
+    def __init__(self, path=STATE_PATH):
+        # Handlers of several collections (threads in the asyncio engine)
+        # share one connection
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # The listener processes write the same file
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS documents ('
+            '  collection TEXT NOT NULL,'
+            '  id BLOB NOT NULL,'
+            '  rows BLOB NOT NULL,'
+            '  PRIMARY KEY (collection, id)'
+            ')')
+        self.conn.commit()
+
+    def load(self, collection):
+        """Yield ``(id, rows)`` of the collection, oldest update first."""
+        with self.lock:
+            stored = self.conn.execute(
+                'SELECT id, rows FROM documents WHERE collection = ? ORDER BY rowid', (collection,)).fetchall()
+
+        for id, rows in stored:
+            yield bson.decode(id)['_id'], bson.decode(rows)['rows']
+
+    def save(self, collection, documents):
+        """Store the rows of ``documents`` (id -> rows), deleting the empty ones."""
+        # REPLACE gives the row a new rowid, keeping the load order
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO documents (collection, id, rows) VALUES (?, ?, ?)',
+                [(collection, bson.encode({'_id': id}), bson.encode({'rows': rows}))
+                 for id, rows in documents.items() if rows])
+            self.conn.executemany(
+                'DELETE FROM documents WHERE collection = ? AND id = ?',
+                [(collection, bson.encode({'_id': id})) for id, rows in documents.items() if not rows])
+            self.conn.commit()
+
+
+class StateWriter:
+    """Writer saving the changed documents to a :class:`StateStore`."""
+
+    def __init__(self, store, spec):
+        self.store = store
+        self.spec = spec
+
+    def prepare(self, table, changed):
+        # Stored as dicts, so a column change between releases loads fine
+        return {id: [row.to_dict() for row in table.get(id) or []] for id in changed}
+
+    def merge(self, older, newer):
+        return {**older, **newer}
+
+    def write(self, documents):
+        if documents:
+            self.store.save(self.spec.collection, documents)
+            logging.debug(f"Saved {len(documents)} documents ({self.spec.collection})")
+        return [], []
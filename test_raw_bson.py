@@ -0,0 +1,149 @@
+"""Checks of the raw BSON element walker against ``bson.decode``.
+
+Run with ``python -m pytest test_raw_bson.py``.  The documents hold every BSON
+type :func:`raw_bson.value_end` sizes, the deprecated ones (undefined,
+DBPointer, symbol) written byte by byte since pymongo no longer encodes them.
+"""
+import struct
+from datetime import datetime
+
+import bson
+from bson import ObjectId
+from bson.binary import Binary
+from bson.code import Code
+from bson.decimal128 import Decimal128
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.raw_bson import RawBSONDocument
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+from raw_bson import DECODE_OPTIONS, RAW_OPTIONS, decode_event, decode_fields
+
+
+def cstring(text):
+    return text.encode() + b'\x00'
+
+
+def string(text):
+    data = text.encode() + b'\x00'
+    return struct.pack('<i', len(data)) + data
+
+
+def document(*elements):
+    """BSON document of ``(type, name, value bytes)`` elements."""
+    body = b''.join(bytes([kind]) + cstring(name) + value for kind, name, value in elements)
+    return struct.pack('<i', len(body) + 5) + body + b'\x00'
+
+
+def encoded(name, value):
+    """Element of ``{name: value}`` as encoded by pymongo."""
+    raw = bson.encode({name: value})
+    return raw[4], name, raw[4 + 1 + len(name) + 1:-1]
+
+
+VALUES = {
+    'double': 1.5,
+    'string': 'kes',
+    'document': {'a': 1, 'b': {'c': 'd'}},
+    'array': [1, 'two', {'three': 3}],
+    'binary': Binary(b'\x00\x01\x02', 0),
+    'uuid': Binary(b'0123456789abcdef', 4),
+    'object_id': ObjectId('5f1d7a3b9c1e4a0012345678'),
+    'bool': True,
+    'datetime': datetime(2023, 1, 2, 3, 4, 5, 678000),
+    'null': None,
+    'regex': Regex('^a.*b$', 'im'),
+    'code': Code('function () { return 1; }'),
+    'code_with_scope': Code('function () { return x; }', {'x': 1}),
+    'int32': 7,
+    'timestamp': Timestamp(1672628645, 3),
+    'int64': 1 << 40,
+    'decimal128': Decimal128('12.50'),
+    'max_key': MaxKey(),
+    'min_key': MinKey(),
+}
+
+DEPRECATED = [
+    (0x06, 'undefined', b''),
+    (0x0C, 'db_pointer', string('loanproducts') + ObjectId('5f1d7a3b9c1e4a0012345679').binary),
+    (0x0E, 'symbol', string('sym')),
+]
+
+
+def all_types():
+    elements = [encoded(name, value) for name, value in VALUES.items()]
+    # Deprecated types in the middle, so they have to be skipped over
+    return document(*elements[:5], *DEPRECATED, *elements[5:])
+
+
+def test_decode_every_field():
+    raw = all_types()
+    expected = bson.decode(raw, DECODE_OPTIONS)
+    assert decode_fields(raw, dict.fromkeys(expected)) == expected
+
+
+def test_decode_one_field_skips_the_others():
+    raw = all_types()
+    expected = bson.decode(raw, DECODE_OPTIONS)
+    for name in expected:
+        assert decode_fields(raw, {name: None}) == {name: expected[name]}, name
+
+
+def test_missing_field():
+    assert decode_fields(all_types(), {'absent': None, 'int32': None}) == {'int32': 7}
+
+
+def test_array_indexes():
+    items = list(VALUES.values())
+    raw = bson.encode({'items': items, 'after': 'x'})
+
+    decoded = decode_fields(raw, {'items': [2, 10], 'after': None})
+    # Cut after the last wanted index, the others left None
+    assert decoded['items'] == [None, None, items[2], *[None] * 7, items[10]]
+    assert decoded['after'] == 'x'
+
+    # Deprecated types as array items
+    raw = document((0x04, 'items', document(*[(kind, str(i), value) for i, (kind, _, value) in enumerate(DEPRECATED)])))
+    expected = bson.decode(raw, DECODE_OPTIONS)['items']
+    assert decode_fields(raw, {'items': [2]})['items'] == [None, None, expected[2]]
+
+
+def test_array_shorter_than_index():
+    raw = bson.encode({'products': [{'name': 'maize'}], 'status': 'paid'})
+    assert decode_fields(raw, {'products': [0, 3], 'status': None}) == {
+        'products': [{'name': 'maize'}], 'status': 'paid'}
+    assert decode_fields(bson.encode({'products': []}), {'products': [0]}) == {'products': []}
+
+
+def test_indexes_on_a_non_array():
+    raw = bson.encode({'products': {'0': 'not a list'}})
+    assert decode_fields(raw, {'products': [0]}) == {'products': {'0': 'not a list'}}
+
+
+def test_decode_event():
+    full_document = all_types()
+    event = {
+        '_id': {'_data': '8263B2A1'},
+        'operationType': 'update',
+        'clusterTime': Timestamp(1672628645, 1),
+        'ns': {'db': 'agt4-kenya-prod', 'coll': 'loanproducts'},
+        'documentKey': {'_id': ObjectId('5f1d7a3b9c1e4a0012345678')},
+        'updateDescription': {'updatedFields': {'status': 'paid'}, 'removedFields': []},
+    }
+    # Written by hand so fullDocument keeps the deprecated types
+    raw = document(*[encoded(name, value) for name, value in event.items()], (0x03, 'fullDocument', full_document))
+
+    decoded = decode_event(RawBSONDocument(raw, RAW_OPTIONS))
+    expected = bson.decode(raw, DECODE_OPTIONS)
+    full = decoded.pop('fullDocument')
+    assert isinstance(full, RawBSONDocument)
+    assert full.raw == full_document
+    assert bson.decode(full.raw, DECODE_OPTIONS) == expected.pop('fullDocument')
+    assert decoded == expected
+
+
+def test_decode_event_passes_dicts_through():
+    event = {'operationType': 'delete'}
+    assert decode_event(event) is event
+
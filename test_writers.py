@@ -0,0 +1,121 @@
+"""Checks of the CSV writers on a small table.
+
+Run with ``python -m pytest test_writers.py``.
+"""
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+from keyed_table import KeyedTable
+from writers import CdcLogWriter, CsvLogWriter, CsvSnapshotWriter, DeltaCsvWriter, read_csv
+
+COLUMNS = ['_id', 'status', 'amount', 'count', 'date_created']
+
+
+def make_spec(tmp_path):
+    return SimpleNamespace(collection='loanproducts', output_name='loanproducts', columns=COLUMNS,
+                           key_columns=['_id'], types={'amount': 'float', 'date_created': 'timestamp'},
+                           csv_path=str(tmp_path / 'loanproducts.csv'))
+
+
+def flush(writer, table, documents):
+    for id, row in documents.items():
+        table.upsert(id, [row] if row else [])
+    return writer.write(writer.prepare(table, table.take_changed()))
+
+
+def test_compaction_keeps_one_format_per_column(tmp_path, monkeypatch):
+    monkeypatch.setattr('writers.COMPACT_EVERY_SECONDS', float('inf'))
+    spec = make_spec(tmp_path)
+    writer = CsvLogWriter(spec)
+    table = KeyedTable(COLUMNS, types=spec.types)
+
+    # Alone in their flush, each would get another format inferred
+    flush(writer, table, {'a': {'_id': 'a', 'status': 'paid', 'amount': 1, 'count': 1,
+                                'date_created': datetime(2023, 1, 1)}})
+    flush(writer, table, {'b': {'_id': 'b', 'status': 'due', 'amount': None, 'count': 2,
+                                'date_created': datetime(2023, 1, 2, 10, 30)}})
+    flush(writer, table, {'c': {'_id': 'c', 'status': 'due', 'amount': 2.5, 'count': 3,
+                                'date_created': datetime(2023, 1, 3, 8, 0, 0, 250000)}})
+    # Deleted and updated since their first segment
+    flush(writer, table, {'b': None, 'a': {'_id': 'a', 'status': 'closed', 'amount': 1, 'count': 1,
+                                           'date_created': datetime(2023, 1, 1)}})
+
+    segments = writer.segments()
+    writer.compact(segments)
+
+    assert not writer.segments()
+    header, lines = read_csv(spec.csv_path, index=True)
+    assert header == COLUMNS
+    assert lines == [
+        ['c', 'due', '2.5', '3', '2023-01-03 08:00:00.250'],
+        ['a', 'closed', '1.0', '1', '2023-01-01 00:00:00.000'],
+    ]
+
+
+def test_snapshot_reads_spilled_rows_as_of_prepare(tmp_path):
+    spec = make_spec(tmp_path)
+    writer = CsvSnapshotWriter(spec)
+    table = KeyedTable(COLUMNS, max_documents=2, types=spec.types)
+
+    def row(id, status):
+        return {'_id': id, 'status': status, 'amount': 1.5, 'count': 1, 'date_created': datetime(2023, 1, 1)}
+
+    for id in 'abcd':
+        table.upsert(id, [row(id, 'due')])
+    assert table.spilled
+
+    payload = writer.prepare(table, table.take_changed())
+    # Changed, evicted and removed after the snapshot, before the write
+    table.upsert('a', [row('a', 'paid')])
+    table.upsert('e', [row('e', 'due')])
+    table.upsert('b', [])
+
+    writer.write(payload)
+    _, lines = read_csv(spec.csv_path, index=True)
+    assert [line[:2] for line in lines] == [['a', 'due'], ['b', 'due'], ['c', 'due'], ['d', 'due']]
+    table.close()
+
+
+def test_cdc_segments_left_unuploaded_are_uploaded_at_startup(tmp_path):
+    spec = make_spec(tmp_path)
+    table = KeyedTable(COLUMNS, types=spec.types)
+    writer = CdcLogWriter(spec)
+    flush(writer, table, {'a': {'_id': 'a', 'status': 'due'}})
+    [segment] = writer.tick(stopping=True)[0]
+
+    # The upload failed: the next run uploads the segment again
+    writer = CdcLogWriter(spec)
+    assert writer.tick(stopping=False) == ([segment], [])
+    writer.uploaded([segment])
+
+    writer = CdcLogWriter(spec)
+    assert writer.tick(stopping=False) == ([], [])
+    flush(writer, table, {'b': {'_id': 'b', 'status': 'due'}})
+    # Numbered after the uploaded segments
+    assert writer.tick(stopping=True)[0] == [segment.replace('000000000001-000000000001', '000000000002-000000000002')]
+
+
+def test_delta_manifest_saved_once_its_objects_are_uploaded(tmp_path):
+    spec = make_spec(tmp_path)
+    table = KeyedTable(COLUMNS, types=spec.types)
+    writer = DeltaCsvWriter(spec)
+    uploads, deletions = flush(writer, table, {'a': {'_id': 'a', 'status': 'due'}})
+    [base] = uploads
+    assert deletions == [] and not os.path.exists(writer.manifest_path)
+
+    # The upload failed: the next run drops the object and does not reuse its name
+    writer = DeltaCsvWriter(spec)
+    assert writer.tick(stopping=False) == ([], [base])
+    assert not os.path.exists(base)
+    [base] = flush(writer, table, {'a': {'_id': 'a', 'status': 'paid'}})[0]
+    assert base.endswith('base-000000000002.csv')
+
+    assert writer.uploaded([base]) == ([writer.manifest_path], [])
+    with open(writer.manifest_path) as f:
+        assert json.load(f)['base'] == base
+
+    # Uploaded again at startup, the remote one may be older
+    writer = DeltaCsvWriter(spec)
+    assert writer.tick(stopping=False) == ([writer.manifest_path], [])
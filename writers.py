@@ -0,0 +1,787 @@
+"""Output formats of the exported collections.
+
+A writer works in two steps: ``prepare`` takes what it needs from the
+:class:`KeyedTable` on the pipeline's transform thread, ``write`` turns that
+into files on the output thread and returns the files to upload and the
+ones to delete remotely.  When the output stage is behind, ``merge`` folds
+two prepared payloads into one so only one write happens.  Writers with work
+due on time define ``tick(stopping)``, called on the output thread between
+writes and when stopping, returning files like ``write``.  Writers that
+track what reached S3 define ``uploaded(paths)``, called once files are
+uploaded, returning the files to upload and delete next like ``write``.
+
+LISTENER_OUTPUTS selects the writers, comma separated:
+
+* ``csv``: the whole table rewritten to ``<name>.csv`` on every flush.
+* ``csv-log``: changed rows appended to log segments in ``<name>/``,
+  periodically compacted into ``<name>.csv`` (instead of ``csv``).
+* ``csv-partitioned``: one CSV per day of ``spec.partition_column`` in
+  ``<name>/dt=YYYY-MM-DD/``, only the days a flush touched are rewritten.
+* ``csv-delta``: the changed rows of every flush in a new immutable delta
+  object, listed with the base snapshot in ``<name>/delta/manifest.json``.
+* ``cdc``: one JSON line per changed document, sequenced, in segments of
+  ``<name>/cdc/`` uploaded once closed.
+* ``parquet``: the whole table rewritten to ``<name>.parquet`` with the
+  column types of the spec (needs ``pyarrow``).
+* ``feather``: the same typed table as uncompressed Arrow IPC in
+  ``<name>.feather``, memory-mappable by readers on the host.
+"""
+import csv
+import glob
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from bson import json_util
+
+from keyed_table import Categories, Timestamps
+from settings import (CDC_SEGMENT_MAX_BYTES, CDC_SEGMENT_MAX_SECONDS, COMPACT_EVERY_SECONDS, COMPACT_MAX_BYTES,
+                      DELTA_REBASE_EVERY_SECONDS, DELTA_REBASE_MAX_RATIO, LOG_SEGMENT_MAX_BYTES, OUTPUT_FORMATS, PARQUET_COMPRESSION, PARQUET_ROW_GROUP_SIZE)
+
+
+def write_atomic(path, write):
+    """Write ``path`` through ``write(tmp_path)``, then move it in place.
+
+    Readers (the Airflow DAGs) see the old file or the new one, never a
+    partial write.
+    """
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def format_datetime(fraction):
+    if fraction == 6:
+        return lambda value: f"{value:%Y-%m-%d %H:%M:%S}.{value.microsecond:06d}"
+    if fraction == 3:
+        return lambda value: f"{value:%Y-%m-%d %H:%M:%S}.{value.microsecond // 1000:03d}"
+    return lambda value: f"{value:%Y-%m-%d %H:%M:%S}"
+
+
+def csv_formatters(rows, width):
+    """Formatter of each column of ``rows``, writing values as pandas did.
+
+    The exports used to go through ``DataFrame.to_csv``: a column of dates
+    became datetime64 (written as days when they are all midnight), a column
+    of numbers with a float or a missing value float64 (``1.0``), anything
+    else was written with ``str()``.  Missing values are empty.
+    """
+    # Per column: [dates, numbers, floats, nulls, midnight, fraction digits]
+    kinds = [[True, True, False, False, True, 0] for _ in range(width)]
+    undecided = list(range(width))
+    for row in rows:
+        if not undecided:
+            break
+        values = row.values()
+        for i in undecided:
+            value, kind = values[i], kinds[i]
+            if is_null(value):
+                kind[3] = True
+            elif isinstance(value, datetime) and kind[0]:
+                kind[1] = False
+                if value.hour or value.minute or value.second or value.microsecond:
+                    kind[4] = False
+                if value.microsecond % 1000:
+                    kind[5] = 6
+                elif value.microsecond:
+                    kind[5] = max(kind[5], 3)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and kind[1]:
+                kind[0] = False
+                kind[2] = kind[2] or isinstance(value, float)
+            else:
+                kind[0] = kind[1] = False
+        undecided = [i for i in undecided if kinds[i][0] or kinds[i][1]]
+
+    formatters = []
+    for dates, numbers, floats, nulls, midnight, fraction in kinds:
+        if dates and not numbers:
+            text = (lambda value: f"{value:%Y-%m-%d}") if midnight else format_datetime(fraction)
+        elif numbers and not dates and (floats or nulls):
+            text = lambda value: repr(float(value))
+        else:
+            text = str
+        formatters.append(lambda value, text=text: '' if is_null(value) else text(value))
+    return formatters
+
+
+def write_csv(path, columns, rows, index=True, mode='w', formatters=None):
+    """Write ``rows`` (table rows, a list or a snapshot) to ``path`` in pandas' CSV layout.
+
+    With ``index`` the first column is the row number, with an empty header.
+    Appending (``mode='a'``) writes the header only to a new file.
+    ``formatters`` defaults to the ones inferred from ``rows``.
+    """
+    formatters = formatters or csv_formatters(rows, len(columns))
+    header = mode == 'w' or not os.path.exists(path)
+    with open(path, mode, newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        if header:
+            writer.writerow(['', *columns] if index else columns)
+        for number, row in enumerate(rows):
+            values = [text(value) for text, value in zip(formatters, row.values())]
+            writer.writerow([number, *values] if index else values)
+
+
+def read_csv(path, index=False):
+    """Header and rows of a CSV as strings, without the index column."""
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        start = 1 if index else 0
+        return header[start:], [line[start:] for line in reader]
+
+
+class ListRow(list):
+    """Row of plain values, read back from a CSV or built by a writer."""
+
+    def values(self):
+        return self
+
+
+class ChangedRows:
+    """Rows of the changed documents, with a deletion marker for the ones removed.
+
+    The rows get a last ``_deleted`` column, False; a row that left the
+    export (its document deleted or filtered out, or one of a multi-row
+    document's keys gone) comes back as a ``True`` row carrying only its key.
+    The keys of each document's rows are indexed to find those.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        # Keys of each document's rows, for the multi-row documents
+        self.keys_of = {}
+
+    def key(self, row):
+        return tuple(row.get(column) for column in self.spec.key_columns)
+
+    def index(self, id, current):
+        """Index the rows of a document, returning the keys its change removed."""
+        if self.spec.key_columns == ['_id']:
+            # A document's rows share its key: it left the export when it has none
+            return [] if current else [(id,)]
+
+        keys = {repr(key): key for key in map(self.key, current)}
+        removed = [key for name, key in self.keys_of.pop(id, {}).items() if name not in keys]
+        if keys:
+            self.keys_of[id] = keys
+        return removed
+
+    def rows(self, table, changed):
+        rows = []
+        for id in changed:
+            current = table.get(id) or []
+            rows.extend(ListRow([*row.values(), False]) for row in current)
+            for key in self.index(id, current):
+                deleted = dict(zip(self.spec.key_columns, key))
+                rows.append(ListRow([*map(deleted.get, self.spec.columns), True]))
+        return rows
+
+    def formatters(self):
+        """One format per column, the same whatever rows a write holds.
+
+        The rows come a flush at a time and compaction copies their text:
+        formats inferred per write would mix ``2023-01-01`` with
+        ``2023-01-02 10:30:00``, or ``1`` with ``1.0``, in a column.  Dates
+        are written in full, to the millisecond of BSON dates, and the
+        ``float`` columns of ``spec.types`` always as floats.
+        """
+        def fixed(kind):
+            def text(value):
+                if is_null(value):
+                    return ''
+                if isinstance(value, datetime):
+                    return full_datetime(value)
+                if kind == 'float' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    return repr(float(value))
+                return str(value)
+            return text
+
+        full_datetime = format_datetime(3)
+        return [fixed(self.spec.types.get(column)) for column in self.spec.columns] + [str]
+
+    def write(self, path, rows, mode='w'):
+        columns = [*self.spec.columns, '_deleted']
+        write_csv(path, columns, rows, index=False, mode=mode, formatters=self.formatters())
+
+
+class CsvSnapshotWriter:
+    """Rewrites the whole export on every flush."""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def prepare(self, table, changed):
+        # Spilled documents are read on the output thread, by write
+        return table.snapshot()
+
+    def merge(self, older, newer):
+        older.close()
+        return newer
+
+    def write(self, rows):
+        # Write .csv
+        try:
+            write_atomic(self.spec.csv_path, lambda path: write_csv(path, self.spec.columns, rows))
+        finally:
+            rows.close()
+        logging.info(f"DATA WRITTEN IN CSV ({self.spec.collection})")
+        return [self.spec.csv_path], []
+
+
+class CsvLogWriter:
+    """Appends changed rows to log segments, compacted into the snapshot.
+
+    Segments live in ``<name>/log-<ms>.csv`` next to ``<name>.csv`` and have
+    the snapshot's columns without the index, plus the ``_deleted`` marker
+    of :class:`ChangedRows`.  A segment is closed once it
+    reaches ``LOG_SEGMENT_MAX_BYTES``; every ``COMPACT_EVERY_SECONDS``, or
+    once the segments reach ``COMPACT_MAX_BYTES``, they are merged into the
+    snapshot (last row per key wins) and deleted.  Readers get the current
+    state from the snapshot followed by the remaining segments.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.directory = os.path.join(os.path.dirname(spec.csv_path), spec.output_name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.changed_rows = ChangedRows(spec)
+        self.segment = None
+        self.last_compaction = time.monotonic()
+
+    def prepare(self, table, changed):
+        return self.changed_rows.rows(table, changed)
+
+    def merge(self, older, newer):
+        return older + newer
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'log-*.csv')))
+
+    def write(self, rows):
+        uploads, deletions = [], []
+
+        if rows:
+            if self.segment is None or os.path.getsize(self.segment) >= LOG_SEGMENT_MAX_BYTES:
+                self.segment = os.path.join(self.directory, f"log-{int(time.time() * 1000):013d}.csv")
+
+            self.changed_rows.write(self.segment, rows, mode='a')
+            logging.info(f"{len(rows)} ROWS APPENDED TO CSV LOG ({self.spec.collection})")
+            uploads.append(self.segment)
+
+        segments = self.segments()
+        if segments and (time.monotonic() - self.last_compaction >= COMPACT_EVERY_SECONDS
+                         or sum(os.path.getsize(segment) for segment in segments) >= COMPACT_MAX_BYTES):
+            self.compact(segments)
+            uploads = [self.spec.csv_path]
+            deletions = segments
+
+        return uploads, deletions
+
+    def compact(self, segments):
+        """Merge the segments into the snapshot, then delete them."""
+        # Text-level merge: values are copied as they were written
+        files = [read_csv(self.spec.csv_path, index=True)] if os.path.exists(self.spec.csv_path) else []
+        files += [read_csv(segment) for segment in segments]
+
+        # Last row per key, in the order the keys were last written
+        keys = [self.spec.columns.index(column) for column in self.spec.key_columns]
+        by_key = {}
+        for header, lines in files:
+            positions = [header.index(column) if column in header else None for column in self.spec.columns]
+            deleted = header.index('_deleted') if '_deleted' in header else None
+            for line in lines:
+                row = ListRow('' if position is None else line[position] for position in positions)
+                key = tuple(row[i] for i in keys)
+                by_key.pop(key, None)
+                if deleted is None or line[deleted] != 'True':
+                    by_key[key] = row
+
+        write_atomic(self.spec.csv_path, lambda path: write_csv(path, self.spec.columns, list(by_key.values())))
+
+        for segment in segments:
+            os.remove(segment)
+        self.segment = None
+        self.last_compaction = time.monotonic()
+
+        logging.info(f"Compacted {len(segments)} CSV log segments ({self.spec.collection})")
+
+
+# Partition of the rows without a date (and of collections without one)
+DEFAULT_PARTITION = 'dt=__HIVE_DEFAULT_PARTITION__'
+
+
+class PartitionedCsvWriter:
+    """Splits the export by day, rewriting the days that changed only.
+
+    The writer indexes which partitions each document's rows are in, so a
+    document moving to another day dirties both the old and the new one.  A
+    partition left without rows has its file deleted.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.directory = os.path.join(os.path.dirname(spec.csv_path), spec.output_name)
+        # document id -> partitions of its rows
+        self.partitions_of = {}
+        # partition -> ids of its documents, in upsert order
+        self.documents = {}
+
+    def partition(self, row):
+        value = row.get(self.spec.partition_column) if self.spec.partition_column else None
+        return f"dt={value:%Y-%m-%d}" if isinstance(value, datetime) else DEFAULT_PARTITION
+
+    def path(self, partition):
+        return os.path.join(self.directory, partition, f"{self.spec.output_name}.csv")
+
+    def prepare(self, table, changed):
+        dirty = set()
+        for id in changed:
+            old = self.partitions_of.pop(id, set())
+            for partition in old:
+                self.documents[partition].pop(id, None)
+
+            new = {self.partition(row) for row in table.get(id) or []}
+            for partition in new:
+                self.documents.setdefault(partition, {})[id] = None
+            if new:
+                self.partitions_of[id] = new
+
+            dirty |= old | new
+
+        payload = {}
+        for partition in dirty:
+            ids = self.documents.get(partition, {})
+            rows = (row for id in ids for row in table.get(id) if self.partition(row) == partition)
+            payload[partition] = list(table.unique(rows))
+            if not ids:
+                self.documents.pop(partition, None)
+        return payload
+
+    def merge(self, older, newer):
+        return {**older, **newer}
+
+    def write(self, partitions):
+        uploads, deletions = [], []
+        for partition, rows in partitions.items():
+            path = self.path(partition)
+            if not rows:
+                if os.path.exists(path):
+                    os.remove(path)
+                    deletions.append(path)
+                continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, lambda tmp_path: write_csv(tmp_path, self.spec.columns, rows))
+            uploads.append(path)
+
+        if partitions:
+            logging.info(f"{len(partitions)} PARTITIONS WRITTEN IN CSV ({self.spec.collection})")
+        return uploads, deletions
+
+
+class DeltaCsvWriter:
+    """Uploads the changed rows only, as immutable delta objects.
+
+    Every flush writes ``<name>/delta/delta-<seq>.csv`` with the rows of the
+    changed documents and the ``_deleted`` marker of :class:`ChangedRows`.
+    ``manifest.json`` lists the current base snapshot (``base-<seq>.csv``,
+    the ``csv`` layout) and the deltas to apply on it in order, the last row
+    per key winning.  It is only saved once the objects it lists are
+    uploaded, then uploaded itself, and uploaded again at startup.
+
+    After ``DELTA_REBASE_EVERY_SECONDS``, or once the deltas reach
+    ``DELTA_REBASE_MAX_RATIO`` of the base's size, the table is written as a
+    new base and the previous base and deltas are deleted.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.directory = os.path.join(os.path.dirname(spec.csv_path), spec.output_name, 'delta')
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        os.makedirs(self.directory, exist_ok=True)
+        self.changed_rows = ChangedRows(spec)
+
+        self.base, self.deltas, self.sequence = None, [], 0
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.base, self.deltas, self.sequence = manifest['base'], manifest['deltas'], manifest['sequence']
+
+        # Objects of a flush that failed before its manifest, maybe uploaded;
+        # its events get replayed
+        listed = {self.manifest_path, self.base, *self.deltas}
+        unlisted = [path for path in glob.glob(os.path.join(self.directory, '*.csv')) if path not in listed]
+        for path in unlisted:
+            os.remove(path)
+            # Numbers not reused: the remote objects are deleted with the next tick
+            self.sequence = max(self.sequence, int(os.path.basename(path)[:-len('.csv')].rsplit('-', 1)[1]))
+        # Sent with the next tick: the remote manifest may be an older one
+        self.uploads = [self.manifest_path] if os.path.exists(self.manifest_path) else []
+        self.deletions = unlisted
+        # (objects, manifest, replaced objects) of the last write, saved once
+        # the objects are uploaded
+        self.pending = None
+
+        self.base_bytes = os.path.getsize(self.base) if self.base else 0
+        self.delta_bytes = sum(os.path.getsize(delta) for delta in self.deltas)
+        self.rebased_at = time.monotonic()
+
+    def prepare(self, table, changed):
+        """``(base snapshot or None, delta rows)``."""
+        if self.base is None or time.monotonic() - self.rebased_at >= DELTA_REBASE_EVERY_SECONDS \
+                or self.delta_bytes >= DELTA_REBASE_MAX_RATIO * self.base_bytes:
+            self.rebased_at, self.delta_bytes = time.monotonic(), 0
+            for id in changed:
+                self.changed_rows.index(id, table.get(id) or [])
+            return table.snapshot(), []
+
+        return None, self.changed_rows.rows(table, changed)
+
+    def merge(self, older, newer):
+        if newer[0] is not None:
+            if older[0] is not None:
+                older[0].close()
+            return newer
+        return older[0], older[1] + newer[1]
+
+    def path(self, kind):
+        self.sequence += 1
+        return os.path.join(self.directory, f"{kind}-{self.sequence:012d}.csv")
+
+    def write(self, payload):
+        base, rows = payload
+        uploads, deletions = [], []
+
+        if base is not None:
+            path = self.path('base')
+            # Formatted like the deltas, which readers apply on top of it
+            formatters = self.changed_rows.formatters()[:-1]
+            try:
+                write_atomic(path, lambda tmp_path: write_csv(tmp_path, self.spec.columns, base, formatters=formatters))
+            finally:
+                base.close()
+            deletions = [self.base, *self.deltas] if self.base else []
+            self.base, self.deltas = path, []
+            self.base_bytes = os.path.getsize(path)
+            uploads.append(path)
+            logging.info(f"DATA REBASED IN CSV DELTAS ({self.spec.collection})")
+
+        if rows:
+            path = self.path('delta')
+            write_atomic(path, lambda tmp_path: self.changed_rows.write(tmp_path, rows))
+            self.deltas.append(path)
+            self.delta_bytes += os.path.getsize(path)
+            uploads.append(path)
+            logging.info(f"{len(rows)} ROWS WRITTEN IN CSV DELTA ({self.spec.collection})")
+
+        if not uploads:
+            return [], []
+
+        manifest = {
+            'base': self.base,
+            'deltas': list(self.deltas),
+            'sequence': self.sequence,
+            'columns': self.spec.columns,
+            'key_columns': self.spec.key_columns,
+        }
+        self.pending = uploads, manifest, deletions
+        return uploads, []
+
+    def uploaded(self, paths):
+        """Save and upload the manifest once its objects are uploaded.
+
+        The objects it replaces are deleted after it is uploaded.
+        """
+        if self.pending is None or not set(self.pending[0]) <= set(paths):
+            return [], []
+        _, manifest, deletions = self.pending
+        self.pending = None
+
+        def dump(path):
+            with open(path, 'w') as f:
+                json.dump(manifest, f, indent=1)
+
+        write_atomic(self.manifest_path, dump)
+        for path in deletions:
+            os.remove(path)
+        return [self.manifest_path], deletions
+
+    def tick(self, stopping):
+        """Upload the manifest left by the previous run and delete its unlisted objects."""
+        uploads, deletions = self.uploads, self.deletions
+        self.uploads, self.deletions = [], []
+        return uploads, deletions
+
+
+class CdcLogWriter:
+    """Change log of the export, one JSON line per changed document.
+
+    Records are ``{"seq", "op", "clusterTime", "key", "rows"}`` in relaxed
+    Extended JSON: ``seq`` increases by one per record across restarts, ``op``
+    is the change event's operation type (``read`` for rows loaded by a
+    backfill or resync), ``key`` the document ``_id`` and ``rows`` its
+    exported rows, empty once the document left the export.
+
+    Records are appended to ``<name>/cdc/open.jsonl``; once it reaches
+    ``CDC_SEGMENT_MAX_BYTES`` or ``CDC_SEGMENT_MAX_SECONDS`` (checked by
+    ``tick`` while no change comes), or when the listener stops, it is closed
+    as ``cdc-<first seq>-<last seq>.jsonl`` and uploaded, never to change
+    again.  Uploaded segments are moved to ``uploaded/``, the ones left after
+    a failed upload are uploaded again at startup.  Events replayed after a
+    restart are logged again (at least once).
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.directory = os.path.join(os.path.dirname(spec.csv_path), spec.output_name, 'cdc')
+        self.open_path = os.path.join(self.directory, 'open.jsonl')
+        self.uploaded_directory = os.path.join(self.directory, 'uploaded')
+        os.makedirs(self.uploaded_directory, exist_ok=True)
+
+        pending = sorted(glob.glob(os.path.join(self.directory, 'cdc-*.jsonl')))
+        closed = sorted(pending + glob.glob(os.path.join(self.uploaded_directory, 'cdc-*.jsonl')), key=os.path.basename)
+        self.sequence = int(closed[-1][:-len('.jsonl')].rsplit('-', 1)[1]) if closed else 0
+        self.first = self.opened_at = None
+        # Closed but not uploaded, or closed at startup: uploaded with the
+        # next write
+        self.uploads = pending
+
+        if os.path.exists(self.open_path):
+            self.recover()
+
+    def recover(self):
+        """Close the segment the previous run left open."""
+        with open(self.open_path) as f:
+            lines = f.read().splitlines()
+
+        # A crash can leave a partial last line; its events get replayed
+        records = []
+        for line in lines:
+            try:
+                records.append(json_util.loads(line))
+            except ValueError:
+                break
+
+        if not records:
+            os.remove(self.open_path)
+            return
+
+        def rewrite(path):
+            with open(path, 'w') as f:
+                f.writelines(line + '\n' for line in lines[:len(records)])
+
+        write_atomic(self.open_path, rewrite)
+        self.first, self.sequence = records[0]['seq'], records[-1]['seq']
+        self.uploads.append(self.close())
+
+    def prepare(self, table, changed):
+        records = []
+        for id, change in changed.items():
+            operation, cluster_time = change or ('read', None)
+            records.append((operation, cluster_time, id, [row.to_dict() for row in table.get(id) or []]))
+        return records
+
+    def merge(self, older, newer):
+        return older + newer
+
+    def write(self, records):
+        uploads, self.uploads = self.uploads, []
+        if not records:
+            return uploads, []
+
+        if self.first is None:
+            self.first, self.opened_at = self.sequence + 1, time.monotonic()
+
+        with open(self.open_path, 'a') as f:
+            for operation, cluster_time, id, rows in records:
+                self.sequence += 1
+                record = {'seq': self.sequence, 'op': operation, 'clusterTime': cluster_time, 'key': id, 'rows': rows}
+                f.write(json_util.dumps(record, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n')
+        logging.info(f"{len(records)} RECORDS APPENDED TO CDC LOG ({self.spec.collection})")
+
+        if os.path.getsize(self.open_path) >= CDC_SEGMENT_MAX_BYTES \
+                or (self.opened_at is not None and time.monotonic() - self.opened_at >= CDC_SEGMENT_MAX_SECONDS):
+            uploads.append(self.close())
+
+        return uploads, []
+
+    def tick(self, stopping):
+        """Close the open segment once it is too old, or when stopping."""
+        uploads, self.uploads = self.uploads, []
+        if self.first is not None and (stopping or time.monotonic() - self.opened_at >= CDC_SEGMENT_MAX_SECONDS):
+            uploads.append(self.close())
+        return uploads, []
+
+    def close(self):
+        path = os.path.join(self.directory, f"cdc-{self.first:012d}-{self.sequence:012d}.jsonl")
+        os.replace(self.open_path, path)
+        self.first = self.opened_at = None
+        return path
+
+    def uploaded(self, paths):
+        """Move the uploaded segments out of the ones to upload."""
+        for path in paths:
+            if os.path.dirname(path) == self.directory and os.path.basename(path).startswith('cdc-'):
+                os.replace(path, os.path.join(self.uploaded_directory, os.path.basename(path)))
+        return [], []
+
+
+def to_number(kind):
+    def convert(value):
+        # Booleans and unparsable strings are not amounts
+        if value is None or isinstance(value, bool):
+            return None
+        try:
+            return kind(value)
+        except (TypeError, ValueError):
+            return None
+    return convert
+
+
+def to_timestamp(value):
+    return value if isinstance(value, datetime) else None
+
+
+def to_bool(value):
+    return None if value is None else bool(value)
+
+
+def to_string(value):
+    return None if value is None else str(value)
+
+
+def categories_array(codes, categories):
+    """Dictionary array of a category column from the table's codes."""
+    import pyarrow as pa
+
+    # Values the same once made strings share an entry, None is null
+    entries, remap = {}, []
+    for value in categories.values[:max(codes, default=-1) + 1]:
+        remap.append(None if value is None else entries.setdefault(to_string(value), len(entries)))
+    indices = pa.array([remap[code] for code in codes], pa.int32())
+    return pa.DictionaryArray.from_arrays(indices, pa.array(list(entries), pa.string()))
+
+
+class ArrowWriter:
+    """Rewrites the whole export as an Arrow table typed after ``spec.types``.
+
+    Dates are UTC timestamps, status/type like columns dictionary encoded and
+    anything else (ids, sub-documents) strings.  Values that do not fit their
+    column's type are written as nulls.  Subclasses pick the file format.
+    """
+
+    format = None
+
+    def __init__(self, spec):
+        # pyarrow takes a while to import, only the typed outputs need it
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise RuntimeError(f"the {self.format} output needs pyarrow") from None
+
+        self.spec = spec
+        kinds = {
+            'timestamp': (pa.timestamp('ms', tz='UTC'), to_timestamp),
+            'bool': (pa.bool_(), to_bool),
+            'int': (pa.int64(), to_number(int)),
+            'float': (pa.float64(), to_number(float)),
+            'category': (pa.dictionary(pa.int32(), pa.string()), to_string),
+            'string': (pa.string(), to_string),
+        }
+        self.kinds = {column: kinds[spec.types.get(column, 'string')] for column in spec.columns}
+        self.schema = pa.schema([(column, type) for column, (type, _) in self.kinds.items()])
+
+    def prepare(self, table, changed):
+        # Spilled documents are read on the output thread, by to_table
+        return table.snapshot(), table.codecs
+
+    def merge(self, older, newer):
+        older[0].close()
+        return newer
+
+    def to_table(self, payload):
+        import pyarrow as pa
+
+        snapshot, codecs = payload
+        try:
+            data = snapshot.to_columns(encoded=True)
+        finally:
+            snapshot.close()
+
+        arrays = []
+        for column, (type, convert) in self.kinds.items():
+            values, codec = data[column], codecs.get(column)
+            # Fast paths when no value is stored as is (see keyed_table)
+            if isinstance(codec, Timestamps) and not any(value.__class__ is tuple for value in values):
+                # Encoded as microseconds already
+                arrays.append(pa.array(values, pa.timestamp('us', tz='UTC')).cast(type, safe=False))
+            elif isinstance(codec, Categories) and all(value.__class__ is int for value in values):
+                arrays.append(categories_array(values, codec))
+            else:
+                if codec is not None:
+                    values = map(codec.decode, values)
+                values = [convert(value) for value in values]
+                if pa.types.is_dictionary(type):
+                    arrays.append(pa.array(values, pa.string()).dictionary_encode())
+                else:
+                    arrays.append(pa.array(values, type))
+
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+
+class ParquetWriter(ArrowWriter):
+    """Typed export in Parquet, with compressed row groups."""
+
+    format = 'parquet'
+
+    def write(self, data):
+        import pyarrow.parquet as pq
+
+        table = self.to_table(data)
+        write_atomic(self.spec.parquet_path, lambda path: pq.write_table(
+            table, path, compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE))
+
+        logging.info(f"DATA WRITTEN IN PARQUET ({self.spec.collection})")
+        return [self.spec.parquet_path], []
+
+
+class FeatherWriter(ArrowWriter):
+    """Typed export in Arrow IPC (Feather v2) for readers on the same host.
+
+    Left uncompressed so ``pyarrow.feather.read_table(path, memory_map=True)``
+    maps the columns instead of copying them.
+    """
+
+    format = 'feather'
+
+    def write(self, data):
+        import pyarrow.feather as feather
+
+        table = self.to_table(data)
+        write_atomic(self.spec.feather_path, lambda path: feather.write_feather(
+            table, path, compression='uncompressed', chunksize=PARQUET_ROW_GROUP_SIZE))
+
+        logging.info(f"DATA WRITTEN IN FEATHER ({self.spec.collection})")
+        return [self.spec.feather_path], []
+
+
+WRITERS = {
+    'csv': CsvSnapshotWriter,
+    'csv-log': CsvLogWriter,
+    'csv-partitioned': PartitionedCsvWriter,
+    'csv-delta': DeltaCsvWriter,
+    'cdc': CdcLogWriter,
+    'parquet': ParquetWriter,
+    'feather': FeatherWriter,
+}
+
+
+def make_writers(spec):
+    return [WRITERS[name.strip()](spec) for name in OUTPUT_FORMATS]